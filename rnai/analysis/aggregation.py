@@ -0,0 +1,125 @@
+import numpy as np
+
+
+class OffTargetSummary(object):
+    """
+    Per hit (target sequence) summary of the siRNA hits of a query.
+
+    All counts, position sets and the on-target histogram are computed from
+    the hit columns with a few sorts and bincounts, instead of comparing hit
+    lists with each other. Positions are kept as merged intervals per hit
+    and as coverage arrays over the query, so large bowtie outputs stay
+    cheap to summarize.
+
+    Parameters
+    ----------
+    hit_names
+            target name of every hit
+    sirna_positions
+            position of the siRNA of every hit on the query
+    is_efficient
+            whether the siRNA of every hit is efficient
+    is_off_target
+            whether every hit is on another target than the main one
+    sirna_size
+            siRNA length, a siRNA covers sirna_size positions from its position
+    sirna_names
+            name of the siRNA of every hit, the position identifies it without
+    """
+
+    def __init__(self, hit_names, sirna_positions, is_efficient, is_off_target, sirna_size, sirna_names=None):
+        hit_names = np.asarray(hit_names, dtype=np.str_)
+        positions = np.asarray(sirna_positions, dtype=np.int64)
+        is_efficient = np.asarray(is_efficient, dtype=np.bool_)
+        is_off_target = np.asarray(is_off_target, dtype=np.bool_)
+        self.sirna_size = sirna_size
+
+        # Hits in order of their first appearance
+        names, first, hit = np.unique(hit_names, return_index=True, return_inverse=True)
+        appearance = np.argsort(first, kind='stable')
+        rank = np.empty(len(names), dtype=np.int64)
+        rank[appearance] = np.arange(len(names))
+        hit = rank[hit]
+        self.hits = names[appearance].tolist()
+        self.hit_counts = np.bincount(hit, minlength=len(self.hits))
+        self.efficient_counts = np.bincount(hit[is_efficient], minlength=len(self.hits))
+
+        # An on-target siRNA counts once in the histogram, however often it hits
+        if sirna_names is None:
+            sirnas = positions
+        else:
+            sirnas = np.unique(np.asarray(sirna_names, dtype=np.str_), return_inverse=True)[1]
+        on_target = ~is_off_target
+        distinct = np.unique(np.stack([sirnas[on_target], positions[on_target]]), axis=1)[1]
+        length = int(positions.max()) + sirna_size if len(positions) else 0
+        self.coverage = self._coverage(distinct, length)
+        self.off_target_coverage = self._coverage(np.unique(positions[is_off_target]), length)
+
+        self._intervals = {
+            'on_target': self._merge(hit[on_target], positions[on_target]),
+            'off_target': self._merge(hit[is_off_target], positions[is_off_target]),
+            'efficient': self._merge(hit[is_efficient], positions[is_efficient]),
+        }
+
+    def _coverage(self, positions, length):
+        """Number of the given siRNA positions covering every query position."""
+        change = np.zeros(length + 1, dtype=np.int64)
+        np.add.at(change, positions, 1)
+        np.add.at(change, positions + self.sirna_size, -1)
+        return np.cumsum(change[:-1])
+
+    def _merge(self, hit, positions):
+        """Merge the siRNA ranges of every hit into (hit, start, stop) intervals."""
+        order = np.lexsort((positions, hit))
+        hit, positions = hit[order], positions[order]
+        new = np.ones(len(hit), dtype=np.bool_)
+        # Sorted ranges of equal length overlap or touch their predecessor
+        new[1:] = (hit[1:] != hit[:-1]) | (positions[1:] > positions[:-1] + self.sirna_size)
+        starts = np.flatnonzero(new)
+        stops = np.append(starts[1:], len(hit))[:len(starts)] - 1
+        return hit[starts], positions[starts], positions[stops] + self.sirna_size
+
+    def table(self):
+        """Return [hit, hits, efficient hits] rows, most hits first (ties in order of appearance)."""
+        order = np.argsort(-self.hit_counts, kind='stable')
+        return [[self.hits[i], int(self.hit_counts[i]), int(self.efficient_counts[i])] for i in order]
+
+    def intervals(self, kind):
+        """Return the covered [start, stop) intervals per hit of kind ('on_target', 'off_target' or 'efficient')."""
+        hit, starts, stops = self._intervals[kind]
+        result = {}
+        for i, start, stop in zip(hit.tolist(), starts.tolist(), stops.tolist()):
+            result.setdefault(self.hits[i], []).append((start, stop))
+        return result
+
+    def positions(self, kind, exclude_off_target=False):
+        """
+        Return the set of covered positions per hit of kind; with
+        exclude_off_target the positions covered by any off-target hit are
+        left out.
+        """
+        excluded = set(np.flatnonzero(self.off_target_coverage).tolist()) if exclude_off_target else set()
+        return {
+            name: set().union(*(range(start, stop) for start, stop in intervals)) - excluded
+            for name, intervals in self.intervals(kind).items()
+        }
+
+    def histogram(self):
+        """Return every position covered by an on-target siRNA, once per siRNA covering it."""
+        return np.repeat(np.arange(len(self.coverage)), self.coverage).tolist()
+
+
+def summarize_records(records, sirna_size):
+    """Summarize si-Fi hit records (dictionaries with hit_name, sirna_name, sirna_position, is_efficient and is_off_target)."""
+    columns = {
+        name: [record[name] for record in records]
+        for name in ('hit_name', 'sirna_name', 'sirna_position', 'is_efficient', 'is_off_target')
+    }
+    return OffTargetSummary(
+        hit_names=columns['hit_name'],
+        sirna_positions=np.array(columns['sirna_position'], dtype=np.float64).astype(np.int64),
+        is_efficient=columns['is_efficient'],
+        is_off_target=columns['is_off_target'],
+        sirna_size=sirna_size,
+        sirna_names=columns['sirna_name'],
+    )
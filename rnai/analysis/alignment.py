@@ -0,0 +1,230 @@
+from array import array
+from collections import namedtuple
+
+import numpy as np
+
+
+# One bowtie hit; query is the number of the siRNA candidate (its 1-based
+# position on the query sequence), mismatches the bowtie mismatch descriptor
+Hit = namedtuple('Hit', ['query', 'reverse', 'target', 'offset', 'sequence', 'other', 'mismatches'])
+
+
+def unique_candidates(query_sequence, sirna_size):
+    """
+    Find the distinct siRNA candidates (windows of sirna_size, case
+    insensitive) of query_sequence.
+
+    Returns the 1-based numbers of the first occurrence of every distinct
+    candidate (ascending) and for every candidate the number of its first
+    occurrence, for AlignmentHits.fan_out.
+    """
+    sequence = query_sequence.upper()
+    windows = max(len(sequence) - sirna_size + 1, 0)
+    kmers = np.array([sequence[i:i+sirna_size].encode() for i in range(windows)], dtype='S%d' % max(sirna_size, 1))
+    _, first, inverse = np.unique(kmers, return_index=True, return_inverse=True)
+    return np.sort(first) + 1, first[inverse] + 1
+
+
+def write_candidates(stream, query_sequence, sirna_size, candidates=None, chunk_size=4096):
+    """
+    Write the siRNA candidates (windows of sirna_size) of query_sequence as
+    FASTA to stream, e.g. the stdin of bowtie, and close it. Candidate i is
+    named 'sirna<i>' after its 1-based position; candidates restricts the
+    output to the given numbers.
+    """
+    sequence = query_sequence.upper().encode()
+    if candidates is None:
+        candidates = range(1, len(sequence) - sirna_size + 2)
+    candidates = [int(i) for i in candidates]
+    try:
+        for start in range(0, len(candidates), chunk_size):
+            stream.write(b''.join(
+                b'>sirna%d\n%s\n' % (i, sequence[i-1:i-1+sirna_size])
+                for i in candidates[start:start + chunk_size]
+            ))
+        stream.close()
+    except BrokenPipeError:
+        # bowtie stopped reading, its exit status tells what went wrong
+        pass
+
+
+def parse_bowtie_lines(lines):
+    """Parse bowtie's default output (bytes or str lines) into Hit tuples, one line at a time."""
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode()
+        fields = line.rstrip('\r\n').split('\t')
+        if len(fields) < 7:
+            continue
+        yield hit_from_row(fields)
+
+
+def hit_from_row(row):
+    """Turn one split bowtie output row into a Hit."""
+    return Hit(
+        query=int(row[0].split('sirna')[1]),
+        reverse=row[1] == '-',
+        target=row[2],
+        offset=int(row[3]),
+        sequence=row[4],
+        other=int(row[6]),
+        mismatches=row[7] if len(row) > 7 else '',
+    )
+
+
+class AlignmentHits(object):
+    """
+    Bowtie hits stored as typed columns instead of lists of strings.
+
+    Target names and mismatch descriptors are interned, so a hit costs a few
+    integers plus its read sequence. rows() gives the hits back in bowtie's
+    own (split) format for the web interface.
+
+    Parameters
+    ----------
+    hits
+            iterable of Hit tuples, e.g. parse_bowtie_lines on bowtie's stdout
+    """
+
+    def __init__(self, hits=()):
+        self.targets = []
+        self.descriptors = ['']
+        target_ids = {}
+        descriptor_ids = {'': 0}
+        query, reverse, target, offset, other, mismatches = (
+            array('l'), array('b'), array('l'), array('q'), array('l'), array('l'))
+        sequences = []
+        for hit in hits:
+            if hit.target not in target_ids:
+                target_ids[hit.target] = len(self.targets)
+                self.targets.append(hit.target)
+            if hit.mismatches not in descriptor_ids:
+                descriptor_ids[hit.mismatches] = len(self.descriptors)
+                self.descriptors.append(hit.mismatches)
+            query.append(hit.query)
+            reverse.append(hit.reverse)
+            target.append(target_ids[hit.target])
+            offset.append(hit.offset)
+            other.append(hit.other)
+            mismatches.append(descriptor_ids[hit.mismatches])
+            sequences.append(hit.sequence.encode())
+
+        self.query = np.array(query, dtype=np.int64)
+        self.reverse = np.array(reverse, dtype=np.bool_)
+        self.target = np.array(target, dtype=np.int32)
+        self.offset = np.array(offset, dtype=np.int64)
+        self.other = np.array(other, dtype=np.int32)
+        self.mismatches = np.array(mismatches, dtype=np.int32)
+        self.sequence = np.array(sequences, dtype='S%d' % max(map(len, sequences), default=1))
+
+    @classmethod
+    def from_columns(cls, query, reverse, target, offset, sequence, other, mismatches, targets, descriptors=('',)):
+        """Build the hits from ready columns, target and mismatches index targets and descriptors."""
+        hits = cls()
+        hits.targets = list(targets)
+        hits.descriptors = list(descriptors)
+        hits.query = np.asarray(query, dtype=np.int64)
+        hits.reverse = np.asarray(reverse, dtype=np.bool_)
+        hits.target = np.asarray(target, dtype=np.int32)
+        hits.offset = np.asarray(offset, dtype=np.int64)
+        hits.other = np.asarray(other, dtype=np.int32)
+        hits.mismatches = np.asarray(mismatches, dtype=np.int32)
+        hits.sequence = np.asarray(sequence, dtype=np.bytes_)
+        return hits
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Build the hits from the arrays of to_arrays()."""
+        return cls.from_columns(
+            query=arrays['query'],
+            reverse=arrays['reverse'],
+            target=arrays['target'],
+            offset=arrays['offset'],
+            sequence=arrays['sequence'],
+            other=arrays['other'],
+            mismatches=arrays['mismatches'],
+            targets=arrays['targets'].tolist(),
+            descriptors=arrays['descriptors'].tolist(),
+        )
+
+    def to_arrays(self):
+        """Return the hits as a dictionary of arrays, e.g. for cache.DiskCache."""
+        return {
+            'query': self.query,
+            'reverse': self.reverse,
+            'target': self.target,
+            'offset': self.offset,
+            'sequence': self.sequence,
+            'other': self.other,
+            'mismatches': self.mismatches,
+            'targets': np.array(self.targets, dtype=np.str_),
+            'descriptors': np.array(self.descriptors, dtype=np.str_),
+        }
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build the hits from split bowtie rows (the format of rows())."""
+        return cls(hit_from_row(row) for row in rows)
+
+    def fan_out(self, representative_of):
+        """
+        Copy the hits of every representative candidate to all candidates it
+        stands for; representative_of[i] is the representative number of
+        candidate i+1 (see unique_candidates). The hits are ordered by
+        candidate, each in the order of its representative.
+        """
+        order = np.argsort(self.query, kind='stable')
+        query = self.query[order]
+        representative_of = np.asarray(representative_of, dtype=np.int64)
+        first = np.searchsorted(query, representative_of, side='left')
+        counts = np.searchsorted(query, representative_of, side='right') - first
+        hits = order[np.repeat(first - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+        return AlignmentHits.from_columns(
+            query=np.repeat(np.arange(1, len(representative_of) + 1), counts),
+            reverse=self.reverse[hits],
+            target=self.target[hits],
+            offset=self.offset[hits],
+            sequence=self.sequence[hits],
+            other=self.other[hits],
+            mismatches=self.mismatches[hits],
+            targets=self.targets,
+            descriptors=self.descriptors,
+        )
+
+    def __len__(self):
+        return len(self.query)
+
+    @property
+    def nbytes(self):
+        """Memory of the hit columns in bytes."""
+        return sum(column.nbytes for column in (
+            self.query, self.reverse, self.target, self.offset, self.sequence, self.other, self.mismatches))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.hit(i)
+
+    def hit(self, i):
+        """Return hit i as a Hit tuple."""
+        return Hit(
+            query=int(self.query[i]),
+            reverse=bool(self.reverse[i]),
+            target=self.targets[self.target[i]],
+            offset=int(self.offset[i]),
+            sequence=self.sequence[i].decode(),
+            other=int(self.other[i]),
+            mismatches=self.descriptors[self.mismatches[i]],
+        )
+
+    def rows(self):
+        """Return the hits as split bowtie output lines (lists of strings)."""
+        return list(self.iter_rows())
+
+    def iter_rows(self):
+        """Yield the rows of rows() one by one."""
+        for hit in self:
+            row = ['sirna%d' % hit.query, '-' if hit.reverse else '+', hit.target, str(hit.offset),
+                   hit.sequence, 'I' * len(hit.sequence), str(hit.other)]
+            if hit.mismatches:
+                row.append(hit.mismatches)
+            yield row
@@ -0,0 +1,102 @@
+import hashlib
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+
+class DiskCache(object):
+    """
+    Content-addressed on-disk cache of numpy arrays.
+
+    An entry is a dictionary of arrays stored as one uncompressed .npz file
+    named after the hash of its key. Reading an entry marks it as recently
+    used (mtime), and the least recently used entries are removed once the
+    cache grows beyond max_bytes. Entries are written to a temporary file and
+    moved in place, so several processes can share the directory.
+
+    Parameters
+    ----------
+    directory
+            cache directory, created if missing
+    max_bytes
+            size bound of all entries together
+    """
+
+    def __init__(self, directory, max_bytes=2 * 1024**3):
+        self.directory = str(directory)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def __getstate__(self):
+        return {'directory': self.directory, 'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state['directory'], state['max_bytes'])
+
+    @staticmethod
+    def key(*parts):
+        """Return the hash key of parts (strings, numbers and tuples of them)."""
+        return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.npz')
+
+    def get(self, key):
+        """Return the arrays stored under key, or None."""
+        path = self.path(key)
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return arrays
+
+    def put(self, key, arrays):
+        """Store a dictionary of arrays under key and evict old entries."""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits max_bytes."""
+        with self._lock:
+            entries = []
+            for folder in os.scandir(self.directory):
+                if not folder.is_dir():
+                    continue
+                for entry in os.scandir(folder.path):
+                    if entry.name.endswith('.npz'):
+                        try:
+                            stat = entry.stat()
+                        except OSError:
+                            continue
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+
+    def clear(self):
+        """Remove all entries."""
+        max_bytes, self.max_bytes = self.max_bytes, -1
+        try:
+            self.evict()
+        finally:
+            self.max_bytes = max_bytes
@@ -7,6 +7,9 @@ import shutil
 import platform
 from types import *
 
+from analysis import indexes
+from analysis import kmer_index
+
 
 def all_dbs(db_location):
     """Get a dictionary of all Bowtie DBs created so far by the user."""
@@ -33,16 +36,33 @@ def get_size_date_of_file(db_file):
     return file_date, int(file_size)
 
 
-def create_bowtie_database(db_name, database_file_location, bowtie_location):
-    """Creates a Bowtie DB."""
+def create_bowtie_database(db_name, database_file_location, bowtie_location, kmer_sizes=None):
+    """Creates a Bowtie DB and the exact match k-mer indexes of kmer_sizes (default kmer_index.KMER_SIZES)."""
 
-    os.chdir(bowtie_location)
-    process = subprocess.Popen(["bowtie-build", database_file_location, str(db_name)])
+    if kmer_sizes is None:
+        kmer_sizes = kmer_index.KMER_SIZES
+    if any(k > kmer_index.MAX_K for k in kmer_sizes):
+        raise ValueError('k-mer indexes can only be built for siRNAs up to %d bases.' % kmer_index.MAX_K)
+    # Relative FASTA paths are relative to the database folder
+    database_file_location = os.path.join(bowtie_location, database_file_location)
+    process = subprocess.Popen(["bowtie-build", database_file_location, str(db_name)], cwd=bowtie_location)
     process.wait()
 
     fpath = os.path.join(bowtie_location, str(db_name) + '.rev.1.ebwt')
 
     if os.path.exists(fpath):
+        # Exact match indexes for mismatches=0, bowtie is used for other siRNA sizes
+        # and for the sizes whose index could not be built
+        base = os.path.join(bowtie_location, str(db_name))
+        for k in kmer_sizes:
+            try:
+                kmer_index.build_kmer_index(database_file_location, base, k)
+            except Exception:
+                logging.exception('Could not build the %d-mer index of %s, bowtie is used instead', k, db_name)
+                # An index of an earlier database of that name would be out of date
+                for path in kmer_index.index_files(base, k).values():
+                    if os.path.exists(path):
+                        os.remove(path)
         fdate, fsize = get_size_date_of_file(fpath)
         return "Database successfully created!", True, fdate, int(fsize*3/1e6)
     else:
@@ -56,7 +76,8 @@ def delete_databases(db_name, db_location):
     """Deletes all selected databases."""
     bowtie_endings = [".1.ebwt", ".2.ebwt", ".3.ebwt", ".4.ebwt", ".rev.1.ebwt", ".rev.2.ebwt"]
     bowtie_was_deleted = False
-    os.chdir(db_location)
+    indexes.RESIDENT_INDEXES.release(db_location, db_name)
+    kmer_index.remove_kmer_index(os.path.join(db_location, str(db_name)))
     try:
         for extension in bowtie_endings:
             del_path = os.path.join(db_location, str(db_name) + extension)
@@ -66,7 +87,7 @@ def delete_databases(db_name, db_location):
             else:
                 bowtie_was_deleted = False
         
-    except (IOError, OSError, WindowsError):
+    except OSError:
         pass
     
     if bowtie_was_deleted:
@@ -1,8 +1,11 @@
 
 
 import math
+import threading
 import warnings
+from collections import OrderedDict
 
+import numpy as np
 from Bio import SeqUtils, Seq
 from Bio import BiopythonWarning
 
@@ -427,4 +430,514 @@ def calculate_free_energy(seq, check=True, strict=True, c_seq=None, shift=0, nn_
     if saltcorr in (6, 7):
         Tm = (1 / (1 / (Tm + 273.15) + corr) - 273.15)
 
-    return deltaG
\ No newline at end of file
+    return deltaG
+
+
+### Compiled lookup engine
+# calculate_free_energy resolves every neighbor through string slicing and
+# dictionary lookups (with reversed-key fallbacks) and builds Seq objects for
+# each call. The siRNA pipeline only ever scores 3-5 nt end fragments, so the
+# tables are resolved once into flat integer-indexed arrays instead.
+# Bases are 2-bit encoded (A=0, C=1, G=2, T=3) and the dangling end '.' gets
+# code 4. A table key 'XY/ZW' is stored at index ((X*5 + Y)*5 + Z)*5 + W.
+
+ALPHABET = 'ACGT.'
+GAP = 4
+NEIGHBOR_INDEXES = len(ALPHABET) ** 4
+
+# bytes.translate tables from sequence characters to codes, 255 is unsupported
+_STRICT_CODES = bytes(ALPHABET[:4].index(chr(i)) if chr(i) in 'ACGT' else 255 for i in range(256))
+_CHECK_CODES = bytes(ALPHABET[:4].index(chr(i).upper()) if chr(i) in 'ACGTacgt' else 255 for i in range(256))
+_COMPLEMENT_CODES = bytes([3, 2, 1, 0]) + bytes(252)
+
+
+class _Unsupported(Exception):
+    """Raised when the engine must hand a sequence to calculate_free_energy (PRIVATE)."""
+
+
+def neighbor_index(x, y, z, w):
+    """Return the array index of the neighbor duplex 5'xy3'/3'zw5'."""
+    return ((x * 5 + y) * 5 + z) * 5 + w
+
+
+def neighbor_key(index):
+    """Return the table key (e.g. 'GT/CA') stored at an array index."""
+    index, w = divmod(index, 5)
+    index, z = divmod(index, 5)
+    x, y = divmod(index, 5)
+    return ALPHABET[x] + ALPHABET[y] + '/' + ALPHABET[z] + ALPHABET[w]
+
+
+def encode(seq, check=True):
+    """Return the 2-bit codes of a sequence as bytes, or None if it has other characters."""
+    codes = str(seq).encode('latin-1', 'replace').translate(_CHECK_CODES if check else _STRICT_CODES)
+    if 255 in codes:
+        return None
+    return codes
+
+
+def encode_array(seq):
+    """Return the 2-bit codes of a sequence as a uint8 array, other characters are 255."""
+    codes = str(seq).encode('latin-1', 'replace').translate(_CHECK_CODES)
+    return np.frombuffer(codes, dtype=np.uint8)
+
+
+def compile_table(*tables, reverse=False):
+    """Resolve lookup tables into a flat array of (dH, dS) tuples.
+
+    Tables are searched in the given order, and with reverse=True the
+    reversed key is tried after each table, the same way
+    calculate_free_energy does for the 'zipping'. Missing entries are None.
+    Keys which are not plain 'XY/ZW' neighbors (e.g. initiation values) are
+    ignored.
+    """
+    compiled = [None] * NEIGHBOR_INDEXES
+    for index in range(NEIGHBOR_INDEXES):
+        key = neighbor_key(index)
+        for table in tables:
+            if key in table:
+                compiled[index] = table[key]
+                break
+            if reverse and key[::-1] in table:
+                compiled[index] = table[key[::-1]]
+                break
+    return compiled
+
+
+def table_array(compiled):
+    """Return a compiled table as a (NEIGHBOR_INDEXES, 2) float array, NaN where missing."""
+    array = np.full((NEIGHBOR_INDEXES, 2), np.nan)
+    for index, energy in enumerate(compiled):
+        if energy is not None:
+            array[index] = energy
+    return array
+
+
+def alignment_plan(length, c_length, shift):
+    """Align a sequence and its complement the way calculate_free_energy does.
+
+    The dangling end handling only depends on the fragment lengths and the
+    shift, so it is done once per shape. Positions refer to the buffer
+    seq + c_seq + GAP. Returns the positions of the left and right dangling
+    end neighbors (or None) and the remaining sequence and complement
+    positions.
+    """
+    gap = length + c_length
+    ts = list(range(length))
+    tc = list(range(length, gap))
+    left_de = None
+    right_de = None
+    if shift or length != c_length:
+        if shift > 0:
+            ts = [gap] * shift + ts
+        if shift < 0:
+            tc = [gap] * -shift + tc
+        if len(tc) > len(ts):
+            ts = ts + [gap] * (len(tc) - len(ts))
+        if len(tc) < len(ts):
+            tc = tc + [gap] * (len(ts) - len(tc))
+        # Remove 'over-dangling' ends
+        while ts[:2] == [gap, gap] or tc[:2] == [gap, gap]:
+            ts = ts[1:]
+            tc = tc[1:]
+        while ts[-2:] == [gap, gap] or tc[-2:] == [gap, gap]:
+            ts = ts[:-1]
+            tc = tc[:-1]
+        if len(ts) < 2:
+            raise _Unsupported()
+        if ts[0] == gap or tc[0] == gap:
+            left_de = (ts[0], ts[1], tc[0], tc[1])
+            ts = ts[1:]
+            tc = tc[1:]
+        if len(ts) < 2:
+            raise _Unsupported()
+        if ts[-1] == gap or tc[-1] == gap:
+            right_de = (tc[-1], tc[-2], ts[-1], ts[-2])
+            ts = ts[:-1]
+            tc = tc[:-1]
+    return left_de, right_de, tuple(ts), tuple(tc)
+
+
+class EnergyCache(object):
+    """Bounded least recently used cache of end energies with hit/miss counters.
+
+    Keys are (table set, fragment, complement, shift, strict) tuples with the
+    fragments as encoded bytes, see EnergyEngine.cache_key. Only a few
+    hundred distinct siRNA ends exist, so one process-wide instance
+    (ENERGY_CACHE) is shared by all engines and requests.
+    """
+
+    def __init__(self, maxsize=65536):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """Return the cached deltaG of key or None."""
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """Store the deltaG of key, evicting the least recently used entries."""
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """Remove all entries and reset the counters."""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Return hits, misses, current and maximum size as a dictionary."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._data), 'maxsize': self.maxsize}
+
+
+ENERGY_CACHE = EnergyCache()
+
+
+class EnergyEngine(object):
+    """Nearest neighbor deltaG on precompiled lookup arrays.
+
+    delta_g returns exactly the value calculate_free_energy returns for the
+    same tables and conditions. Sequences the engine does not handle (anything
+    but A, C, G and T, or fragments shorter than two nucleotides) are passed
+    on to calculate_free_energy.
+
+    With a cache (an EnergyCache) every deltaG is only calculated once.
+    """
+
+    def __init__(self, nn_table=RNA_NN3, tmm_table=DNA_TMM1, imm_table=DNA_IMM1,
+                 de_table=RNA_DE2, selfcomp=False, Na=20, K=50, Tris=0, Mg=0,
+                 dNTPs=0, saltcorr=5, cache=None):
+        self.tables = (nn_table, tmm_table, imm_table, de_table)
+        self.cache = cache
+        self.key = tuple(map(id, self.tables)) + (selfcomp, Na, K, Tris, Mg, dNTPs, saltcorr)
+        self.zip_table = compile_table(imm_table, nn_table, reverse=True)
+        self.tmm_table = compile_table(tmm_table)
+        self.de_table = compile_table(de_table)
+        self.zip_array = table_array(self.zip_table)
+        self.tmm_array = table_array(self.tmm_table)
+        self.de_array = table_array(self.de_table)
+        self.init = nn_table['init']
+        self.init_at = nn_table['init_A/T']
+        self.init_gc = nn_table['init_G/C']
+        self.init_one_gc = nn_table['init_oneG/C']
+        self.init_all_at = nn_table['init_allA/T']
+        self.init_5t = nn_table['init_5T/A']
+        self.sym = nn_table['sym'] if selfcomp else None
+        self.selfcomp = selfcomp
+        self.salt = dict(Na=Na, K=K, Tris=Tris, Mg=Mg, dNTPs=dNTPs, method=saltcorr)
+        self.saltcorr = saltcorr
+        self._salt_by_length = {}
+        self._plans = {}
+
+    def delta_g(self, seq, c_seq=None, shift=0, check=True, strict=True):
+        """Return the deltaG of seq, see calculate_free_energy."""
+        s = encode(seq, check)
+        c = encode(c_seq, check) if c_seq else None
+        if s is not None and (c is not None or not c_seq):
+            key = self.cache_key(s, c, shift, strict)
+            delta_g = self.cache.get(key) if self.cache is not None else None
+            if delta_g is not None:
+                return delta_g
+            try:
+                delta_g = self.encoded_delta_g(s, c, shift, strict)
+            except _Unsupported:
+                pass
+            else:
+                if self.cache is not None:
+                    self.cache.put(key, delta_g)
+                return delta_g
+        return self.reference_delta_g(seq, c_seq, shift, check, strict)
+
+    def cache_key(self, s, c, shift, strict):
+        """Return the EnergyCache key of encoded fragments."""
+        return (self.key, bytes(s), None if c is None else bytes(c), shift, strict)
+
+    def reference_delta_g(self, seq, c_seq=None, shift=0, check=True, strict=True):
+        """Return the deltaG computed by calculate_free_energy itself."""
+        nn_table, tmm_table, imm_table, de_table = self.tables
+        salt = dict(self.salt)
+        return calculate_free_energy(
+            seq, check=check, strict=strict, c_seq=c_seq, shift=shift,
+            nn_table=nn_table, tmm_table=tmm_table, imm_table=imm_table,
+            de_table=de_table, selfcomp=self.selfcomp, saltcorr=salt.pop('method'),
+            **salt)
+
+    def salt_entropy(self, length):
+        """Return the entropy salt correction for a sequence length."""
+        if self.saltcorr != 5:
+            # Only method 5 corrects deltaS, the others only change Tm.
+            return 0
+        if length not in self._salt_by_length:
+            self._salt_by_length[length] = salt_correction(seq='A' * length, **self.salt)
+        return self._salt_by_length[length]
+
+    def plan(self, length, c_length, shift):
+        """Return the cached alignment_plan of a fragment shape."""
+        key = (length, c_length, shift)
+        if key not in self._plans:
+            if length < 2 or c_length < 2:
+                raise _Unsupported()
+            self._plans[key] = alignment_plan(length, c_length, shift)
+        return self._plans[key]
+
+    def encoded_delta_g(self, s, c=None, shift=0, strict=True):
+        """Return the deltaG of encoded sequence and complement (see encode).
+
+        Without c the perfect complement of s is used.
+        """
+        if c is None:
+            c = s.translate(_COMPLEMENT_CODES)
+        shape = (len(s), len(c), shift)
+        plan = self._plans.get(shape) or self.plan(*shape)
+        left_de, right_de, ts, tc = plan
+        sc = s + c + b'\x04'
+        delta_h = 0
+        delta_s = 0
+        # Dangling ends
+        if left_de is not None:
+            index = ((sc[left_de[0]] * 5 + sc[left_de[1]]) * 5 + sc[left_de[2]]) * 5 + sc[left_de[3]]
+            energy = self.de_table[index]
+            if energy is None:
+                raise KeyError(neighbor_key(index))
+            delta_h += energy[0]
+            delta_s += energy[1]
+        if right_de is not None:
+            index = ((sc[right_de[0]] * 5 + sc[right_de[1]]) * 5 + sc[right_de[2]]) * 5 + sc[right_de[3]]
+            energy = self.de_table[index]
+            if energy is None:
+                raise KeyError(neighbor_key(index))
+            delta_h += energy[0]
+            delta_s += energy[1]
+        # Terminal mismatches
+        tmm_table = self.tmm_table
+        lo = 0
+        hi = len(ts)
+        if hi >= 2:
+            energy = tmm_table[((sc[tc[1]] * 5 + sc[tc[0]]) * 5 + sc[ts[1]]) * 5 + sc[ts[0]]]
+            if energy is not None:
+                delta_h += energy[0]
+                delta_s += energy[1]
+                lo = 1
+        if hi - lo >= 2:
+            energy = tmm_table[((sc[ts[-2]] * 5 + sc[ts[-1]]) * 5 + sc[tc[-2]]) * 5 + sc[tc[-1]]]
+            if energy is not None:
+                delta_h += energy[0]
+                delta_s += energy[1]
+                hi -= 1
+
+        # Initiation, in the same order as calculate_free_energy
+        delta_h += self.init[0]
+        delta_s += self.init[1]
+        if 1 in s or 2 in s:
+            delta_h += self.init_one_gc[0]
+            delta_s += self.init_one_gc[1]
+        else:
+            delta_h += self.init_all_at[0]
+            delta_s += self.init_all_at[1]
+        if s[0] == 3:
+            delta_h += self.init_5t[0]
+            delta_s += self.init_5t[1]
+        if s[-1] == 0:
+            delta_h += self.init_5t[0]
+            delta_s += self.init_5t[1]
+        at = (s[0] == 0 or s[0] == 3) + (s[-1] == 0 or s[-1] == 3)
+        gc = 2 - at
+        delta_h += self.init_at[0] * at
+        delta_s += self.init_at[1] * at
+        delta_h += self.init_gc[0] * gc
+        delta_s += self.init_gc[1] * gc
+
+        # Finally, the 'zipping'
+        zip_table = self.zip_table
+        for i in range(lo, hi - 1):
+            index = ((sc[ts[i]] * 5 + sc[ts[i + 1]]) * 5 + sc[tc[i]]) * 5 + sc[tc[i + 1]]
+            energy = zip_table[index]
+            if energy is not None:
+                delta_h += energy[0]
+                delta_s += energy[1]
+            elif strict:
+                raise ValueError('no data for neighbors \'' + neighbor_key(index) + '\'')
+            else:
+                warnings.warn('no data for neighbors \'' + neighbor_key(index) +
+                              '\'. Calculation will be wrong',
+                              BiopythonWarning)
+
+        if self.sym is not None:
+            delta_h += self.sym[0]
+            delta_s += self.sym[1]
+        delta_s += self._salt_by_length.get(len(s)) or self.salt_entropy(len(s))
+
+        tao = 273.15 + 22 # Constant temperature tao in Kelvin
+        return (delta_h * 1000 - tao * delta_s) / 1000
+
+    def batch_delta_g(self, s, c=None, shift=0, strict=True):
+        """Return the deltaG of every row of encoded fragment arrays.
+
+        s is an (N, n) array of 2-bit codes (see encode_array) and c an
+        optional (N, m) array of complements, without it the perfect
+        complement is used. The result is identical to calling
+        encoded_delta_g row by row. Identical rows are calculated once, and
+        with a cache only rows which are not cached yet.
+        """
+        s = np.asarray(s, dtype=np.uint8)
+        c = None if c is None else np.asarray(c, dtype=np.uint8)
+        rows = s if c is None else np.concatenate([s, c], axis=1)
+        if not len(rows):
+            return np.zeros(0)
+        if rows.shape[1] <= 31:
+            # Pack each row into one integer, base 4
+            packed = rows.astype(np.int64) @ (4 ** np.arange(rows.shape[1], dtype=np.int64))
+            unique, first, inverse = np.unique(packed, return_index=True, return_inverse=True)
+        else:
+            unique, first, inverse = np.unique(rows, axis=0, return_index=True, return_inverse=True)
+        keys = [self.cache_key(s[row], None if c is None else c[row], shift, strict) for row in first]
+        if self.cache is None:
+            values = [None] * len(keys)
+        else:
+            values = [self.cache.get(key) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is None]
+        if missing:
+            missing_rows = first[missing]
+            delta_g = self.compute_batch_delta_g(
+                s[missing_rows], None if c is None else c[missing_rows], shift, strict)
+            for i, value in zip(missing, delta_g.tolist()):
+                values[i] = value
+                if self.cache is not None:
+                    self.cache.put(keys[i], value)
+        return np.array(values)[inverse.reshape(-1)]
+
+    def compute_batch_delta_g(self, s, c=None, shift=0, strict=True):
+        """Calculate batch_delta_g column-wise in the same order as encoded_delta_g."""
+        s = np.asarray(s, dtype=np.int64)
+        c = 3 - s if c is None else np.asarray(c, dtype=np.int64)
+        if s.shape[1] < 2 or c.shape[1] < 2:
+            raise ValueError('fragments must have at least two nucleotides')
+        left_de, right_de, ts, tc = self.plan(s.shape[1], c.shape[1], shift)
+        rows = s.shape[0]
+        sc = np.concatenate([s, c, np.full((rows, 1), GAP)], axis=1)
+        delta_h = np.zeros(rows)
+        delta_s = np.zeros(rows)
+
+        def lookup(array, a, b, x, y):
+            index = ((sc[:, a] * 5 + sc[:, b]) * 5 + sc[:, x]) * 5 + sc[:, y]
+            return index, array[index, 0], array[index, 1]
+
+        # Dangling ends
+        for de in (left_de, right_de):
+            if de is not None:
+                index, dh, ds = lookup(self.de_array, *de)
+                missing = np.isnan(dh)
+                if missing.any():
+                    raise KeyError(neighbor_key(index[missing][0]))
+                delta_h += dh
+                delta_s += ds
+        # Terminal mismatches
+        lo = np.zeros(rows, dtype=np.int64)
+        hi = np.full(rows, len(ts))
+        if len(ts) >= 2:
+            index, dh, ds = lookup(self.tmm_array, tc[1], tc[0], ts[1], ts[0])
+            found = ~np.isnan(dh)
+            delta_h += np.where(found, dh, 0.0)
+            delta_s += np.where(found, ds, 0.0)
+            lo += found
+            index, dh, ds = lookup(self.tmm_array, ts[-2], ts[-1], tc[-2], tc[-1])
+            found = ~np.isnan(dh) & (hi - lo >= 2)
+            delta_h += np.where(found, dh, 0.0)
+            delta_s += np.where(found, ds, 0.0)
+            hi -= found
+
+        # Initiation, in the same order as calculate_free_energy
+        delta_h += self.init[0]
+        delta_s += self.init[1]
+        has_gc = ((s == 1) | (s == 2)).any(axis=1)
+        delta_h += np.where(has_gc, self.init_one_gc[0], self.init_all_at[0])
+        delta_s += np.where(has_gc, self.init_one_gc[1], self.init_all_at[1])
+        delta_h += np.where(s[:, 0] == 3, self.init_5t[0], 0.0)
+        delta_s += np.where(s[:, 0] == 3, self.init_5t[1], 0.0)
+        delta_h += np.where(s[:, -1] == 0, self.init_5t[0], 0.0)
+        delta_s += np.where(s[:, -1] == 0, self.init_5t[1], 0.0)
+        at = np.isin(s[:, 0], (0, 3)).astype(np.int64) + np.isin(s[:, -1], (0, 3))
+        gc = 2 - at
+        delta_h += self.init_at[0] * at
+        delta_s += self.init_at[1] * at
+        delta_h += self.init_gc[0] * gc
+        delta_s += self.init_gc[1] * gc
+
+        # Finally, the 'zipping'
+        for i in range(len(ts) - 1):
+            index, dh, ds = lookup(self.zip_array, ts[i], ts[i + 1], tc[i], tc[i + 1])
+            zipped = (lo <= i) & (i < hi - 1)
+            missing = zipped & np.isnan(dh)
+            if missing.any():
+                key = neighbor_key(index[missing][0])
+                if strict:
+                    raise ValueError('no data for neighbors \'' + key + '\'')
+                warnings.warn('no data for neighbors \'' + key +
+                              '\'. Calculation will be wrong',
+                              BiopythonWarning)
+            zipped &= ~missing
+            delta_h += np.where(zipped, dh, 0.0)
+            delta_s += np.where(zipped, ds, 0.0)
+
+        if self.sym is not None:
+            delta_h += self.sym[0]
+            delta_s += self.sym[1]
+        delta_s += self.salt_entropy(s.shape[1])
+
+        tao = 273.15 + 22 # Constant temperature tao in Kelvin
+        return (delta_h * 1000 - tao * delta_s) / 1000
+
+
+_ENGINES = {}
+_ENGINES_LOCK = threading.Lock()
+
+
+def get_engine(nn_table=RNA_NN3, tmm_table=DNA_TMM1, imm_table=DNA_IMM1, de_table=RNA_DE2):
+    """Return the shared EnergyEngine compiled for a set of tables."""
+    key = (id(nn_table), id(tmm_table), id(imm_table), id(de_table))
+    with _ENGINES_LOCK:
+        if key not in _ENGINES:
+            _ENGINES[key] = EnergyEngine(nn_table, tmm_table, imm_table, de_table, cache=ENERGY_CACHE)
+        return _ENGINES[key]
+
+
+
+def calculate_free_energy_batch(seqs, c_seqs=None, shifts=0, strict=True, nn_table=RNA_NN3,
+          tmm_table=DNA_TMM1, imm_table=DNA_IMM1, de_table=RNA_DE2):
+    """Return the deltaG of many fragments at once.
+
+    seqs is an (N, n) array of 2-bit encoded fragments (see encode_array),
+    c_seqs an optional (N, m) array of complements for dangling ends and
+    shifts either one shift for all rows or an array with one per row.
+    Gives the same values as calculate_free_energy for every row.
+    """
+    engine = get_engine(nn_table, tmm_table, imm_table, de_table)
+    seqs = np.asarray(seqs)
+    if np.ndim(shifts) == 0:
+        return engine.batch_delta_g(seqs, c_seqs, int(shifts), strict)
+    shifts = np.asarray(shifts)
+    delta_g = np.empty(len(seqs))
+    for shift in np.unique(shifts):
+        rows = shifts == shift
+        c_rows = None if c_seqs is None else np.asarray(c_seqs)[rows]
+        delta_g[rows] = engine.batch_delta_g(seqs[rows], c_rows, int(shift), strict)
+    return delta_g
\ No newline at end of file
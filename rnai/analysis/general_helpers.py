@@ -8,7 +8,6 @@ import tempfile
 import json
 from operator import itemgetter
 from itertools import groupby
-from collections import Counter
 
 
 from Bio.Seq import Seq
@@ -18,6 +17,8 @@ from Bio.SeqFeature import FeatureLocation
 from Bio import SeqIO
 from Bio.SeqFeature import SeqFeature
 
+from analysis import aggregation
+
 def show_info_message(self, message):
         """Pop up an info message."""
         QtGui.QMessageBox.information(self, u"Information",message)
@@ -111,53 +112,17 @@ def prepare_json_data(f_in):
 def get_table_data(f_in):
     """Extracts a summary of all and efficient hits."""
     query = prepare_json_data(f_in)
-
-    # Get number of hits per query
-    hit_counter = Counter(player['hit_name'] for player in query)
-    efficicent_counter = Counter(player['hit_name'] for player in query if player['is_efficient'])
-    #hit_overview = hit_counter.most_common()
-    table_data = []
-    for x in hit_counter.most_common():
-        for y in efficicent_counter.most_common():
-            if x[0] == y[0]:
-                #print y[1]
-                table_data.append([x[0], x[1], y[1]])
-        if x[0] not in list(efficicent_counter):
-            table_data.append([x[0], x[1], 0])
-    return table_data
+    # The hit counts do not depend on the siRNA size
+    return aggregation.summarize_records(query, sirna_size=1).table()
 
 def get_target_data(f_in, sirna_size):
     """Extracts the target hits and positions."""
     query = prepare_json_data(f_in)
-    off_target_positions = set()
-    off_target_dict = {}
-    main_target_positions = set()
-    main_target_dict = {}
-    efficient_dict = {}
-    main_hits_histo = []
-    ready_sirnas = []
-    main_target_ready = []
-    for data in query:
-        #print data['sirna_name'], data['sirna_position'], data['sirna_position']+21, data['is_efficient'], data['sirna_sequence']
-        plot_range = set(range(int(data['sirna_position']), int(data['sirna_position']) + sirna_size))
-        plot_range_l = range(int(data['sirna_position']), int(data['sirna_position']) + sirna_size)
-        if data['is_efficient']:
-            if data['sirna_name'] not in ready_sirnas:
-                if data['hit_name'] in efficient_dict.keys():
-                    list(efficient_dict[data['hit_name']]).extend(plot_range_l)
-                else:
-                    efficient_dict[data['hit_name']] = plot_range_l
-                ready_sirnas.append(data['sirna_name'])
-        if data['is_off_target']:
-            off_target_positions = off_target_positions | plot_range
-            off_target_dict[data['hit_name']] = off_target_positions
-        else:
-            if (data['sirna_name'], data['sirna_position']) not in main_target_ready:
-                main_target_ready.append((data['sirna_name'], data['sirna_position']))
-                main_target_positions = main_target_positions | plot_range
-                main_target_dict[data['hit_name']] = main_target_positions - off_target_positions
-                main_hits_histo.extend(plot_range)
-
+    summary = aggregation.summarize_records(query, sirna_size)
+    off_target_dict = summary.positions('off_target')
+    main_target_dict = summary.positions('on_target', exclude_off_target=True)
+    efficient_dict = summary.positions('efficient')
+    main_hits_histo = summary.histogram()
     return off_target_dict, main_target_dict, efficient_dict, main_hits_histo
 
 
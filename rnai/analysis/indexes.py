@@ -0,0 +1,134 @@
+import mmap
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+BOWTIE_ENDINGS = [".1.ebwt", ".2.ebwt", ".3.ebwt", ".4.ebwt", ".rev.1.ebwt", ".rev.2.ebwt"]
+
+
+class ResidentIndexes(object):
+    """
+    Keeps the bowtie indexes of recently used databases mapped and asks the
+    kernel to cache them.
+
+    bowtie 1 has no server mode, every alignment is a new process. Instead
+    the index files of a database are memory-mapped here and their pages
+    read ahead (MADV_WILLNEED), again on every use. bowtie is run with --mm
+    and maps the same pages, so it usually finds them in the page cache
+    instead of reading the whole index from disk. This is only a hint: the
+    pages are not locked (mlock would pin the whole index against the
+    memory limit of the server) and the kernel may drop them under memory
+    pressure, bowtie then reads them from disk as without this class.
+
+    At most max_indexes databases are kept (least recently used ones are
+    released first) and a database not used for idle_seconds is released.
+
+    Parameters
+    ----------
+    max_indexes
+            maximum number of resident databases
+    idle_seconds
+            time after which an unused database is released
+    """
+
+    BOWTIE_ARGS = ['--mm']
+
+    def __init__(self, max_indexes=4, idle_seconds=1800):
+        self.max_indexes = max_indexes
+        self.idle_seconds = idle_seconds
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def acquire(self, bowtie_location, bowtie_db):
+        """
+        Map the index of bowtie_db (or keep it mapped), ask for its pages to
+        be cached and return the extra bowtie arguments to use it.
+        """
+        base = os.path.join(bowtie_location, str(bowtie_db))
+        files = [base + ending for ending in BOWTIE_ENDINGS if os.path.exists(base + ending)]
+        if not files:
+            return list(self.BOWTIE_ARGS)
+        key = tuple((path, os.stat(path).st_mtime_ns, os.stat(path).st_size) for path in files)
+
+        with self._lock:
+            entry = self._indexes.pop(base, None)
+            if entry is not None and entry['key'] != key:
+                # The database was rebuilt
+                self._close(entry)
+                entry = None
+            if entry is None:
+                entry = {'key': key, 'maps': [self._map(path) for path in files]}
+            else:
+                # Pages may have been dropped under memory pressure
+                for mapping in entry['maps']:
+                    self._advise(mapping)
+            entry['used'] = time.monotonic()
+            self._indexes[base] = entry
+            self._evict()
+            self._start_reaper()
+        return list(self.BOWTIE_ARGS)
+
+    def release(self, bowtie_location, bowtie_db):
+        """Release the index of bowtie_db, e.g. before it is deleted."""
+        with self._lock:
+            entry = self._indexes.pop(os.path.join(bowtie_location, str(bowtie_db)), None)
+            if entry is not None:
+                self._close(entry)
+
+    def resident(self):
+        """Return the index base paths which are mapped, least recently used first."""
+        with self._lock:
+            return list(self._indexes)
+
+    def evict_idle(self):
+        """Release all indexes not used for idle_seconds."""
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        now = time.monotonic()
+        for base in list(self._indexes):
+            if len(self._indexes) > self.max_indexes or now - self._indexes[base]['used'] > self.idle_seconds:
+                self._close(self._indexes.pop(base))
+
+    def _start_reaper(self):
+        if self._reaper is None:
+            self._reaper = threading.Thread(target=self._reap, daemon=True)
+            self._reaper.start()
+
+    def _reap(self):
+        while True:
+            time.sleep(max(self.idle_seconds / 2, 1))
+            self.evict_idle()
+
+    @classmethod
+    def _map(cls, path):
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        cls._advise(mapping)
+        return mapping
+
+    @staticmethod
+    def _advise(mapping):
+        if mapping is None:
+            return
+        if hasattr(mmap, 'MADV_WILLNEED'):
+            mapping.madvise(mmap.MADV_WILLNEED)
+        else:
+            # Touch every page
+            for offset in range(0, len(mapping), mmap.PAGESIZE):
+                mapping[offset]
+
+    @staticmethod
+    def _close(entry):
+        for mapping in entry['maps']:
+            if mapping is not None:
+                mapping.close()
+
+
+RESIDENT_INDEXES = ResidentIndexes()
@@ -0,0 +1,98 @@
+import datetime
+import json
+import threading
+import uuid
+import concurrent.futures
+
+from django.db import connection
+from django.utils import timezone
+
+from analysis.models import Job
+
+
+class QueueFull(Exception):
+    """Raised by JobQueue.submit when max_queued jobs are already waiting."""
+
+
+class JobQueue(object):
+    """
+    Jobs run by a bounded pool of worker threads, their state kept in the
+    database (models.Job).
+
+    A job is a function called as function(progress, *args); it reports its
+    stage with progress(stage, done=None, total=None) and returns a JSON
+    serializable result. The state of every job (queued, running, done or
+    failed), its stage, progress, result or error are stored in a Job row, so
+    they can be polled from any request. Jobs still queued or running when
+    the queue was last stopped are marked as failed when it is created
+    again, and finished jobs are deleted after max_age seconds.
+
+    Parameters
+    ----------
+    max_workers
+            number of jobs run at the same time
+    max_queued
+            number of jobs that may wait for a worker
+    max_age
+            seconds finished jobs are kept
+    """
+
+    COLUMNS = ('job_id', 'state', 'stage', 'done', 'total', 'created', 'updated', 'result', 'error')
+
+    def __init__(self, max_workers=2, max_queued=32, max_age=7 * 24 * 3600):
+        self.max_queued = max_queued
+        self.max_age = max_age
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._queued = 0
+        self._lock = threading.Lock()
+        Job.objects.filter(state__in=('queued', 'running')).update(
+            state='failed', error='Interrupted by a server restart.', updated=timezone.now()
+        )
+
+    def submit(self, function, *args):
+        """Queue function(progress, *args) and return the id of the job."""
+        with self._lock:
+            if self._queued >= self.max_queued:
+                raise QueueFull('Too many queued jobs, please try again later.')
+            self._queued += 1
+        try:
+            if self.max_age is not None:
+                Job.objects.filter(
+                    state__in=('done', 'failed'),
+                    updated__lt=timezone.now() - datetime.timedelta(seconds=self.max_age)
+                ).delete()
+            job = Job.objects.create(job_id=uuid.uuid4().hex)
+        except BaseException:
+            with self._lock:
+                self._queued -= 1
+            raise
+        self._executor.submit(self._run, job.job_id, function, args)
+        return job.job_id
+
+    def get(self, job_id):
+        """Return the state of a job as a dictionary (with the result once done), or None."""
+        return Job.objects.filter(job_id=job_id).values(*self.COLUMNS).first()
+
+    def _run(self, job_id, function, args):
+        with self._lock:
+            self._queued -= 1
+        try:
+            self._update(job_id, state='running')
+
+            def progress(stage, done=None, total=None):
+                self._update(job_id, stage=stage, done=done, total=total)
+
+            try:
+                # Results which cannot be stored fail the job, not the worker
+                result = json.loads(json.dumps(function(progress, *args)))
+            except Exception as e:
+                self._update(job_id, state='failed', error=str(e) or type(e).__name__)
+            else:
+                self._update(job_id, state='done', stage='done', result=result)
+        finally:
+            # The worker threads are not request threads, nobody else closes their connections
+            connection.close()
+
+    def _update(self, job_id, **values):
+        # update() does not set auto_now fields
+        Job.objects.filter(job_id=job_id).update(updated=timezone.now(), **values)
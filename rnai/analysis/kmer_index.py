@@ -0,0 +1,313 @@
+import glob
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+from Bio import SeqIO
+from Bio.Seq import Seq
+
+from analysis import alignment
+
+
+# 2 bit codes of the bases, everything else (N and other IUPAC codes) is 4
+_CODES = bytes(
+    {ord('A'): 0, ord('C'): 1, ord('G'): 2, ord('T'): 3,
+     ord('a'): 0, ord('c'): 1, ord('g'): 2, ord('t'): 3}.get(i, 4)
+    for i in range(256)
+)
+
+
+# Longest k-mers whose 2 bit codes fit into uint64
+MAX_K = 32
+# siRNA sizes the k-mer index is built for when a database is created
+KMER_SIZES = (21,)
+# K-mers sorted in memory at a time while an index is built
+BUILD_CHUNK_SIZE = 1 << 24
+
+
+def kmer_codes(sequence, k):
+    """
+    Return the 2 bit codes (uint64) of all k-mers of sequence and a mask of
+    the k-mers which contain only A, C, G and T (case insensitive).
+    """
+    if k > MAX_K:
+        raise ValueError('k-mers longer than %d bases do not fit into 64 bits' % MAX_K)
+    bases = np.frombuffer(sequence.encode().translate(_CODES), dtype=np.uint8)
+    windows = len(bases) - k + 1
+    if windows <= 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.bool_)
+    invalid = np.concatenate([[0], np.cumsum(bases > 3)])
+    valid = invalid[k:] == invalid[:-k]
+    bases = np.where(bases > 3, 0, bases).astype(np.uint64)
+    codes = np.zeros(windows, dtype=np.uint64)
+    for j in range(k):
+        codes = (codes << np.uint64(2)) | bases[j:j+windows]
+    return codes, valid
+
+
+def index_files(base, k):
+    """Return the file names of the k-mer index of the bowtie database base (path without endings)."""
+    prefix = '%s.kmer%d' % (base, k)
+    return {
+        'codes': prefix + '.codes.npy',
+        'targets': prefix + '.targets.npy',
+        'offsets': prefix + '.offsets.npy',
+        'names': prefix + '.names.json',
+    }
+
+
+def build_kmer_index(fasta_file, base, k=21, chunk_size=BUILD_CHUNK_SIZE):
+    """
+    Build the exact match k-mer index of a database FASTA file next to its
+    bowtie index: the sorted k-mer codes of all references with the
+    reference and offset of every k-mer. K-mers with ambiguous bases are left
+    out, as bowtie does not align to them without mismatches.
+
+    The index is sorted on disk: runs of chunk_size k-mers are sorted in
+    memory and written next to the index, then merged part by part into the
+    index files. A part holds about chunk_size k-mers (about 20 bytes each),
+    but all k-mers of one code are merged together, so a k-mer repeated more
+    than chunk_size times (e.g. a long poly-A stretch) makes its part that
+    large. The split points sampled from the runs grow with the number of
+    runs, i.e. with the size of the database (8 bytes per sample, about
+    runs**2 samples).
+    """
+    if k > MAX_K:
+        raise ValueError('k-mers longer than %d bases do not fit into 64 bits' % MAX_K)
+    files = index_files(base, k)
+    work_directory = tempfile.mkdtemp(prefix='.kmer', dir=os.path.dirname(os.path.abspath(base)))
+    try:
+        names, runs, length = _write_runs(fasta_file, k, chunk_size, work_directory)
+        offset_type = np.uint32 if length <= np.iinfo(np.uint32).max else np.uint64
+        _merge_runs(runs, files, offset_type, chunk_size)
+        with open(files['names'] + '.tmp', 'w') as f:
+            json.dump(names, f)
+        # The codes last, load_kmer_index watches them
+        for name in ('names', 'targets', 'offsets', 'codes'):
+            os.replace(files[name] + '.tmp', files[name])
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+        for path in files.values():
+            if os.path.exists(path + '.tmp'):
+                os.remove(path + '.tmp')
+    return files
+
+
+def _write_runs(fasta_file, k, chunk_size, directory):
+    """
+    Write the k-mers of fasta_file as runs of at most about chunk_size,
+    each sorted by code, into directory. Returns the reference names, the
+    file names of the runs and the length of the longest reference.
+    """
+    names, runs, buffered = [], [], []
+    count = length = 0
+    for record in SeqIO.parse(fasta_file, 'fasta'):
+        sequence = str(record.seq)
+        # Long references are split into chunks overlapping by k-1 bases
+        for start in range(0, max(len(sequence) - k + 1, 0), chunk_size):
+            codes, valid = kmer_codes(sequence[start:start + chunk_size + k - 1], k)
+            positions = np.flatnonzero(valid)
+            buffered.append((
+                codes[positions],
+                np.full(len(positions), len(names), dtype=np.uint32),
+                positions.astype(np.uint64) + np.uint64(start),
+            ))
+            count += len(positions)
+            if count >= chunk_size:
+                runs.append(_write_run(buffered, directory, len(runs)))
+                buffered, count = [], 0
+        length = max(length, len(sequence))
+        names.append(record.id)
+    if buffered or not runs:
+        runs.append(_write_run(buffered, directory, len(runs)))
+    return names, runs, length
+
+
+def _write_run(buffered, directory, number):
+    """Sort buffered (codes, targets, offsets) chunks by code and save them as run number."""
+    if buffered:
+        codes, targets, offsets = (np.concatenate(column) for column in zip(*buffered))
+    else:
+        codes, targets, offsets = np.zeros(0, np.uint64), np.zeros(0, np.uint32), np.zeros(0, np.uint64)
+    # Stable, so the k-mers of a code stay in reference and offset order
+    order = np.argsort(codes, kind='stable')
+    run = {}
+    for name, column in (('codes', codes), ('targets', targets), ('offsets', offsets)):
+        run[name] = os.path.join(directory, '%d.%s.npy' % (number, name))
+        np.save(run[name], column[order])
+    return run
+
+
+def _merge_runs(runs, files, offset_type, chunk_size):
+    """
+    Merge sorted runs into the index files (written with a .tmp ending).
+
+    The merge goes through ranges of codes split at every n-th code of every
+    run, so a range holds about chunk_size k-mers; all k-mers of a code are
+    in one range, however many there are. Ties are ordered by run, i.e. by
+    reference and offset.
+    """
+    # The runs are only mapped for their headers, parts are read from the files
+    columns = [{name: np.load(path, mmap_mode='r') for name, path in run.items()} for run in runs]
+    total = sum(len(run['codes']) for run in columns)
+    step = max(chunk_size // len(runs), 1)
+    samples = np.unique(np.concatenate([
+        _read_part(run['codes'], i, i + 1) for run in columns for i in range(0, len(run['codes']), step)
+    ] + [np.zeros(0, dtype=np.uint64)]))
+    # About step k-mers (of all runs) lie between two samples
+    bounds = samples[::len(runs)]
+
+    dtypes = {'codes': np.uint64, 'targets': np.uint32, 'offsets': offset_type}
+    outputs = {name: open(files[name] + '.tmp', 'wb') for name in dtypes}
+    try:
+        for name, output in outputs.items():
+            np.lib.format.write_array_header_1_0(output, {
+                'descr': np.lib.format.dtype_to_descr(np.dtype(dtypes[name])),
+                'fortran_order': False,
+                'shape': (total,),
+            })
+        starts = [0] * len(columns)
+        for bound in list(bounds[1:]) + [None]:
+            stops = [_part_stop(run['codes'], start, bound, step) for run, start in zip(columns, starts)]
+            parts = list(zip(columns, starts, stops))
+            # The codes come first and give the order of the part
+            for name, output in outputs.items():
+                column = np.concatenate([_read_part(run[name], start, stop) for run, start, stop in parts])
+                if name == 'codes':
+                    order = np.argsort(column, kind='stable')
+                output.write(column[order].astype(dtypes[name]).tobytes())
+            starts = stops
+    finally:
+        for output in outputs.values():
+            output.close()
+
+
+def _part_stop(codes, start, bound, step):
+    """
+    Return the end of the part of the sorted codes which starts at start and
+    ends before bound (None for the rest). The codes are read forward in
+    windows of step, a part rarely spans more than one window.
+    """
+    if bound is None:
+        return len(codes)
+    stop = start
+    while stop < len(codes):
+        window = _read_part(codes, stop, min(stop + step, len(codes)))
+        found = int(np.searchsorted(window, bound, side='left'))
+        stop += found
+        if found < len(window):
+            break
+    return stop
+
+
+def _read_part(array, start, stop):
+    """
+    Read array[start:stop] of a memory-mapped .npy file from the file, so
+    the merged parts do not stay mapped in the memory of the process.
+    """
+    return np.fromfile(array.filename, dtype=array.dtype, count=stop - start,
+                       offset=array.offset + start * array.itemsize)
+
+
+def remove_kmer_index(base):
+    """Remove the k-mer indexes (of all k) of the bowtie database base."""
+    for path in glob.glob(glob.escape(base) + '.kmer*'):
+        os.remove(path)
+
+
+class KmerIndex(object):
+    """
+    Memory-mapped exact match k-mer index of a bowtie database.
+
+    Looking up the candidates of a query is a binary search per k-mer and
+    strand in the sorted codes, so exact (mismatches=0) off-target searches
+    need no bowtie process.
+
+    Parameters
+    ----------
+    base
+            path of the bowtie database without endings
+    k
+            k-mer length (siRNA size) the index was built for
+    """
+
+    def __init__(self, base, k=21):
+        files = index_files(base, k)
+        self.k = k
+        self.codes = np.load(files['codes'], mmap_mode='r')
+        self.targets = np.load(files['targets'], mmap_mode='r')
+        self.offsets = np.load(files['offsets'], mmap_mode='r')
+        with open(files['names']) as f:
+            self.names = json.load(f)
+
+    def align(self, query_sequence, candidates=None):
+        """
+        Return the exact hits of all k-mers of query_sequence on both strands
+        as AlignmentHits, in the format bowtie -a -v 0 reports them.
+        candidates restricts the search to the given 1-based k-mer numbers.
+        """
+        k = self.k
+        query_sequence = query_sequence.upper()
+        reverse_sequence = str(Seq(query_sequence).reverse_complement())
+        forward_codes, valid = kmer_codes(query_sequence, k)
+        # Code of the reverse complement of every k-mer, in query order
+        reverse_codes = kmer_codes(reverse_sequence, k)[0][::-1]
+        if candidates is not None:
+            valid = valid & np.isin(np.arange(len(valid)), np.asarray(candidates, dtype=np.int64) - 1)
+        candidates = np.flatnonzero(valid)
+
+        columns = []
+        for reverse, codes in ((False, forward_codes), (True, reverse_codes)):
+            codes = codes[candidates]
+            first = np.searchsorted(self.codes, codes, side='left')
+            last = np.searchsorted(self.codes, codes, side='right')
+            counts = last - first
+            # Index of every hit into the sorted codes
+            hit_candidates = np.repeat(candidates, counts)
+            starts = np.repeat(first - np.cumsum(counts) + counts, counts)
+            hits = starts + np.arange(counts.sum())
+            columns.append((hit_candidates, np.full(len(hits), reverse), hits))
+
+        candidate, reverse, hits = (np.concatenate(column) for column in zip(*columns))
+        # Per candidate the forward hits before the reverse ones
+        order = np.argsort(candidate, kind='stable')
+        candidate, reverse, hits = candidate[order], reverse[order], hits[order]
+
+        windows = len(query_sequence) - k + 1
+        forward_windows = np.array([query_sequence[i:i+k].encode() for i in range(max(windows, 0))], dtype='S%d' % k)
+        reverse_windows = np.array([reverse_sequence[i:i+k].encode() for i in range(max(windows, 0))], dtype='S%d' % k)[::-1]
+        # The reference strand is reported, i.e. the reverse complement for '-' hits
+        sequence = np.where(reverse, reverse_windows[candidate], forward_windows[candidate])
+
+        return alignment.AlignmentHits.from_columns(
+            query=candidate + 1,
+            reverse=reverse,
+            target=np.asarray(self.targets[hits]),
+            offset=np.asarray(self.offsets[hits]),
+            sequence=sequence,
+            other=np.zeros(len(hits), dtype=np.int32),
+            mismatches=np.zeros(len(hits), dtype=np.int32),
+            targets=self.names,
+        )
+
+
+_INDEXES = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+def load_kmer_index(base, k=21):
+    """Return the shared k-mer index of the bowtie database base, or None if it was not built."""
+    path = index_files(base, k)['codes']
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    with _INDEXES_LOCK:
+        cached = _INDEXES.get((base, k))
+        if cached is None or cached[0] != key:
+            cached = (key, KmerIndex(base, k))
+            _INDEXES[(base, k)] = cached
+        return cached[1]
@@ -0,0 +1,26 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from analysis import snps
+
+
+class Command(BaseCommand):
+    help = 'Convert snp.json into the memory-mapped SNP store read by the pipeline (snp.bin next to it).'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'json_path', nargs='?',
+            help='snp.json to convert (default: Bowtie/snp.json)'
+        )
+        parser.add_argument('--output', help='location of the store (default: snp.bin next to json_path)')
+
+    def handle(self, *args, **options):
+        json_path = options['json_path'] or os.path.join(settings.BASE_DIR, 'Bowtie', 'snp.json')
+        store_path = options['output'] or os.path.join(os.path.dirname(os.path.abspath(json_path)), snps.SNP_STORE)
+        try:
+            snps.convert_snp_json(json_path, store_path)
+        except (OSError, ValueError) as e:
+            raise CommandError(f'Cannot convert {json_path}: {e}')
+        self.stdout.write(f'Wrote {store_path}')
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('job_id', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('state', models.CharField(choices=[('queued', 'queued'), ('running', 'running'), ('done', 'done'), ('failed', 'failed')], default='queued', max_length=16)),
+                ('stage', models.CharField(default='queued', max_length=32)),
+                ('done', models.IntegerField(null=True)),
+                ('total', models.IntegerField(null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True, db_index=True)),
+                ('result', models.JSONField(null=True)),
+                ('error', models.TextField(null=True)),
+            ],
+        ),
+    ]
@@ -1,3 +1,17 @@
 from django.db import models
 
-# Create your models here.
+
+class Job(models.Model):
+    """State of a background pipeline run of jobs.JobQueue."""
+
+    STATES = [(state, state) for state in ('queued', 'running', 'done', 'failed')]
+
+    job_id = models.CharField(max_length=32, primary_key=True)
+    state = models.CharField(max_length=16, choices=STATES, default='queued')
+    stage = models.CharField(max_length=32, default='queued')
+    done = models.IntegerField(null=True)
+    total = models.IntegerField(null=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True, db_index=True)
+    result = models.JSONField(null=True)
+    error = models.TextField(null=True)
@@ -0,0 +1,109 @@
+from collections import deque
+
+import numpy as np
+from Bio.Seq import Seq
+
+
+# Motifs that cause damaging to cells when they occur on a siRNA (either strand)
+DAMAGING_MOTIFS = ["GGAATGT", "GAGGTAG", "AGGTAGT", "ACCCTGT", "AGCAGCA", "GCAGCAT", "GTGCAAA", "AGTGCAA", "CAGTGCA"  , "AAGTGCT"  , "AAAGTGC"    , "TCACATT", "ATTGCAC", "TCAAGTA", "TCACAGT", "CACAGTG", "AGCACCA", "GTAAACA", "GGCAGTG", "ACCCGTA", "TAAGGCA", "AAGGCAC", "CCCTGAG", "TGGTCCC", "ATGGCTT", "ACATTCA", "TGACCTA", "CCAGTGT", "AACACTG", "AATACTG", "TCCCTTT", "GCTACAT", "GGAAGAC", "CTTTGGT", "AAGGTGC", "AGCTTAT", "AGCTGCC", "GGCTCAG", "TGCATTG", "ACAGTAC", "GGAGTGT", "CGTACCG", "ATTGCTT", "GCTGGTG", "GTGGTTT", "GTAGTGT", "ACAGTAT", "GAGAACT", "TGCATAG", "TAATGCT", "ATGGCAC", "GGACGGA", "CGTGTCT", "GATATGT", "GTAACAG", "TGAAATG", "CCTTCAT", "AATCTCA", "ACTGCAT", "TGTGCTT", "GATTGTC", "GTCAGTT", "TTGTTCG", "TGTGT", "GTGGTTGTT"]
+
+
+class MotifIndex(object):
+    """
+    Aho-Corasick automaton over a motif set and its reverse complements.
+
+    The automaton is compiled once into a complete transition table, so a
+    sequence of any length is scanned in a single pass no matter how many
+    motifs there are.
+
+    Parameters
+    ----------
+    motifs
+            motif sequences, the reverse complements are added automatically
+    """
+
+    def __init__(self, motifs):
+        self.motifs = [motif.strip().upper() for motif in motifs if motif.strip()]
+        patterns = set(self.motifs) | {str(Seq(motif).reverse_complement()) for motif in self.motifs}
+        alphabet = sorted(set(''.join(patterns)))
+
+        # Trie of all patterns; shortest[state] is the length of the shortest
+        # pattern ending in that state (0 for none)
+        goto = [{}]
+        shortest = [0]
+        for pattern in patterns:
+            state = 0
+            for base in pattern:
+                if base not in goto[state]:
+                    goto.append({})
+                    shortest.append(0)
+                    goto[state][base] = len(goto) - 1
+                state = goto[state][base]
+            if not shortest[state] or len(pattern) < shortest[state]:
+                shortest[state] = len(pattern)
+
+        # Failure links (breadth first) folded into the transition table
+        fail = [0] * len(goto)
+        delta = [dict() for _ in goto]
+        queue = deque()
+        for base in alphabet:
+            delta[0][base] = goto[0].get(base, 0)
+            if base in goto[0]:
+                queue.append(goto[0][base])
+        while queue:
+            state = queue.popleft()
+            inherited = shortest[fail[state]]
+            if inherited and (not shortest[state] or inherited < shortest[state]):
+                shortest[state] = inherited
+            for base in alphabet:
+                if base in goto[state]:
+                    child = goto[state][base]
+                    fail[child] = delta[fail[state]][base]
+                    delta[state][base] = child
+                    queue.append(child)
+                else:
+                    delta[state][base] = delta[fail[state]][base]
+        self.delta = delta
+        self.shortest = shortest
+
+    @classmethod
+    def from_file(cls, path):
+        """Load a motif list with one motif per line ('#' and '>' lines are ignored)."""
+        with open(path) as f:
+            motifs = [line for line in f if not line.lstrip().startswith(('#', '>'))]
+        return cls(motifs)
+
+    def matches(self, sequence):
+        """Yield (end, length) for every position where a motif ends, with the shortest such motif."""
+        delta = self.delta
+        shortest = self.shortest
+        state = 0
+        for end, base in enumerate(sequence):
+            state = delta[state].get(base, 0)
+            if shortest[state]:
+                yield end, shortest[state]
+
+    def search(self, sequence):
+        """Return True if any motif (or reverse complement) occurs in sequence."""
+        for _ in self.matches(sequence):
+            return True
+        return False
+
+    def damaged_windows(self, sequence, size):
+        """
+        Return a boolean array over all windows of length size of sequence
+        (window i starts at position i) that contain a motif.
+        """
+        windows = max(len(sequence) - size + 1, 0)
+        coverage = np.zeros(windows + 1, dtype=np.int64)
+        for end, length in self.matches(sequence):
+            # Windows i with i <= end-length+1 and i+size-1 >= end
+            first = max(end - size + 1, 0)
+            last = min(end - length + 1, windows - 1)
+            if length <= size and first <= last:
+                coverage[first] += 1
+                coverage[last + 1] -= 1
+        return np.cumsum(coverage[:-1]) > 0
+
+
+DAMAGING_INDEX = MotifIndex(DAMAGING_MOTIFS)
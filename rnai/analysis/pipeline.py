@@ -2,17 +2,82 @@ import subprocess
 import tempfile
 import os
 import numpy as np
-import json
 import re
-import sys
 import csv
+import threading
+import multiprocessing
+import concurrent.futures
 from Bio         import SeqIO, SeqUtils
 from Bio.Seq     import Seq
-from collections import Counter
+from analysis    import aggregation
+from analysis    import alignment
 from analysis    import free_energy
-from analysis    import general_helpers
+from analysis    import indexes
+from analysis    import kmer_index
+from analysis    import motifs
+from analysis    import snps
 
 
+def read_lunp(path, sirna_size, usecols=None):
+    """
+    Read an RNAplfold lunp file into a float32 matrix.
+
+    Comment lines and the first sirna_size-1 rows (which are not complete)
+    are skipped, the rest is parsed by numpy's C reader. Row i is position
+    i+sirna_size, column 0 is the position and column j the probability
+    that the j bases ending there are unpaired. usecols keeps only the
+    given columns.
+    """
+    with open(path, 'rb') as f:
+        skipped = 0
+        position = f.tell()
+        line = f.readline()
+        while line and (line.lstrip().startswith(b'#') or skipped < sirna_size-1):
+            if not line.lstrip().startswith(b'#'):
+                skipped += 1
+            position = f.tell()
+            line = f.readline()
+        if not line:
+            return np.zeros((0, sirna_size+1 if usecols is None else len(usecols)), dtype=np.float32)
+        f.seek(position)
+        return np.loadtxt(f, dtype=np.float32, usecols=usecols, ndmin=2)
+
+
+# Start method of the batch process pool, forking the threaded server could
+# copy locks held by other threads into the workers
+BATCH_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+def stitch_lunp(cores, chunks, folded, sirna_size):
+    """
+    Join the lunp matrices of folded chunks (see SifiPipeline.fold_chunks)
+    into the one of the whole sequence: the rows of every core, numbered by
+    their position on the whole sequence.
+    """
+    rows = []
+    for (core_start, core_end), (chunk_start, _), chunk_data in zip(cores, chunks, folded):
+        # 1-based positions of the core, the rows start at position sirna_size
+        first = max(core_start + 1, sirna_size)
+        if first > core_end:
+            continue
+        core_rows = chunk_data[first - chunk_start - sirna_size:core_end - chunk_start - sirna_size + 1].copy()
+        core_rows[:, 0] = np.arange(first, core_end + 1)
+        rows.append(core_rows)
+    return np.concatenate(rows) if rows else np.zeros((0, sirna_size+1), dtype=np.float32)
+
+
+def round_probabilities(values, digits=7):
+    """
+    Widen float32 unpaired probabilities (see read_lunp) to float64 rounded
+    to the significant digits RNAplfold prints (%.7g). The results are the
+    values of the lunp file instead of their float32 neighbours, which would
+    move thresholds and rounding ties.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    magnitude = np.floor(np.log10(np.abs(np.where(values == 0, 1, values))))
+    scale = 10.0 ** (digits - 1 - magnitude)
+    return np.round(values * scale) / scale
+
 
 class SifiPipeline(object):
     """
@@ -79,13 +144,75 @@ class SifiPipeline(object):
     SIRNA_START_POSITION = 0                     
     OVERHANG = 2                                 
     END_NUCLOTIDES = 3                          
-
-    def __init__(self):
+    PLFOLD_CHUNK_SIZE = 20000
+    # Fields of the records of iter_records and the short sort keys of candidate_page
+    RECORD_FIELDS = [
+        'sirna_position', 'sirna_sequence', 'is_efficient', 'SNP_exist', 'strand_selection',
+        'end_stability', 'sense5_MFE_enegery', 'anti_sense5_MFE_enegery', 'delta_MFE_enegery',
+        'target_site_accessibility', 'accessibility_value', 'gc_content', 'thermo_effcicient',
+    ]
+    # Record fields rounded to 4 digits by iter_records
+    ROUNDED_FIELDS = ('sense5_MFE_enegery', 'anti_sense5_MFE_enegery', 'delta_MFE_enegery', 'accessibility_value')
+    SORT_KEYS = {
+        'position': 'sirna_position',
+        'sequence': 'sirna_sequence',
+        'delta_MFE': 'delta_MFE_enegery',
+        'accessibility': 'accessibility_value',
+        'gc': 'gc_content',
+    }
+
+    def __init__(self, cache=None):
         
         self._snp_data = None,
         self._bowtie_data = None,
         self._luna_data = None,
         self._output_data = None
+        self._output_table = None
+        self._output_orders = {}
+        self._target = None
+        self._candidate_cache = None
+        self._lock = threading.RLock()
+        # process_data parameters the query was run with
+        self.design = {}
+        self.motif_index = motifs.DAMAGING_INDEX
+        self.indexes = indexes.RESIDENT_INDEXES
+        # Optional cache.DiskCache for RNAplfold and bowtie results
+        self.cache = cache
+        # RNAplfold processes of one long sequence, None for one per CPU
+        self.fold_workers = None
+
+    def __getstate__(self):
+        # Locks and process-wide indexes are not pickled, see registry.PipelineRegistry
+        state = self.__dict__.copy()
+        del state['_lock']
+        del state['indexes']
+        state['_candidate_cache'] = None
+        state['_output_orders'] = {}
+        if state['motif_index'] is motifs.DAMAGING_INDEX:
+            state['motif_index'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+        self.indexes = indexes.RESIDENT_INDEXES
+        if self.motif_index is None:
+            self.motif_index = motifs.DAMAGING_INDEX
+
+    def memory_size(self):
+        """Return the approximate memory of the query data held by the pipeline in bytes."""
+        size = len(getattr(self, '_query_sequence', ''))
+        for data in (self._bowtie_data, getattr(self, '_lunp_data', None)):
+            size += getattr(data, 'nbytes', 0)
+        if self._candidate_cache is not None:
+            size += self._candidate_cache[1].nbytes
+        if getattr(self, '_output_table', None) is not None:
+            size += self._output_table.nbytes
+        size += sum(order.nbytes for order in self._output_orders.values())
+        if self._output_data:
+            # The dictionaries of table_records, about 1 kB per siRNA
+            size += 1024 * len(self._output_data)
+        return size
 
     def run_pipeline(
         self,
@@ -95,36 +222,170 @@ class SifiPipeline(object):
         query_sequences:str = None,
         sirna_size: int = 21,
         mismatches:int = 0,
+        progress = None,
     ):
-        SNP_LOCATION = os.path.join(bowtie_location, 'snp.json')
-        if not os.path.exists(SNP_LOCATION):
-            raise ValueError(f'try to open SNP file at {SNP_LOCATION}, failed!')
-        with open(SNP_LOCATION) as f:
-            self.SNPs = json.load(f)
-
-        for seq_record in SeqIO.parse(query_sequences, "fasta"):
-            # Store ID and sequence
-            query_name = seq_record.id
-            query_sequence = str(seq_record.seq)
-
-            bowtie_data = self.run_bowtie(
+        """
+        Run the pipeline for the single query sequence of a FASTA file;
+        multi FASTA files are run per record by run_batch or iter_batch.
+        """
+        records = list(SeqIO.parse(query_sequences, "fasta"))
+        if len(records) != 1:
+            raise ValueError('Expected one query sequence, got {} (use the batch mode for several).'.format(len(records)))
+        SNP_LOCATION = os.path.join(bowtie_location, snps.SNP_STORE)
+        self.SNPs = snps.load_snp_index(SNP_LOCATION)
+
+        return self.run_record(
+            query_name=records[0].id,
+            query_sequence=str(records[0].seq),
+            bowtie_db=bowtie_db,
+            rnaplfold_location=rnaplfold_location,
+            bowtie_location=bowtie_location,
+            sirna_size=sirna_size,
+            mismatches=mismatches,
+            progress=progress,
+        )
+
+    def run_record(
+        self,
+        query_name: str = None,
+        query_sequence: str = None,
+        bowtie_db: str = None,
+        rnaplfold_location: str = None,
+        bowtie_location: str = None,
+        sirna_size: int = 21,
+        mismatches: int = 0,
+        progress = None,
+    ):
+        """
+        Align and fold one query sequence and make it the current one for process_data.
+
+        Alignment and RNAplfold are independent, so they run at the same time.
+        progress is called with the stage the run waits for, 'alignment'
+        and then 'folding'.
+        """
+        if progress is not None:
+            progress('alignment')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            alignment_future = executor.submit(
+                self.align,
                 query_sequence=query_sequence,
                 bowtie_db=bowtie_db,
                 bowtie_location=bowtie_location,
                 sirna_size=sirna_size,
                 mismatches=mismatches,
             )
-            lunp_data = self.run_rnaplfold(
+            folding_future = executor.submit(
+                self.run_rnaplfold,
                 query_name=query_name, 
                 sirna_size=sirna_size,
                 query_sequence=query_sequence,
                 rnaplfold_location=rnaplfold_location
             )
+            bowtie_data = alignment_future.result()
+            if progress is not None:
+                progress('folding')
+            lunp_data = folding_future.result()
+        with self._lock:
             self._bowtie_data = bowtie_data
             self._lunp_data = lunp_data
-
+            self._query_sequence = query_sequence
+            self._sirna_size = sirna_size
+            self._candidate_cache = None
         return bowtie_data, lunp_data
 
+    def run_batch(
+        self,
+        bowtie_db: str = None,
+        rnaplfold_location: str = None,
+        bowtie_location: str = None,
+        query_sequences: str = None,
+        sirna_size: int = 21,
+        mismatches: int = 0,
+        design: dict = None,
+        max_workers: int = None,
+        progress = None,
+    ):
+        """
+        Run the pipeline for every record of a multi FASTA file in a process pool.
+
+        Returns a dictionary record id -> result (see iter_batch) in record
+        order. progress is called with (record id, finished records, total
+        records) after every record.
+        """
+        results = {}
+        batch = self.iter_batch(
+            bowtie_db=bowtie_db,
+            rnaplfold_location=rnaplfold_location,
+            bowtie_location=bowtie_location,
+            query_sequences=query_sequences,
+            sirna_size=sirna_size,
+            mismatches=mismatches,
+            design=design,
+            max_workers=max_workers,
+        )
+        for record_id, result, done, total in batch:
+            results[record_id] = result
+            if progress is not None:
+                progress(record_id, done, total)
+        record_ids = [record.id for record in SeqIO.parse(query_sequences, "fasta")]
+        return {record_id: results[record_id] for record_id in record_ids}
+
+    def iter_batch(
+        self,
+        bowtie_db: str = None,
+        rnaplfold_location: str = None,
+        bowtie_location: str = None,
+        query_sequences: str = None,
+        sirna_size: int = 21,
+        mismatches: int = 0,
+        design: dict = None,
+        max_workers: int = None,
+    ):
+        """
+        Run the pipeline for every record of a multi FASTA file in a process
+        pool and yield (record id, result, finished records, total records)
+        as the records finish.
+
+        A result holds 'pipeline', a SifiPipeline with the record as its
+        current query (ready for process_data), its 'align_data' and
+        'lunp_data' and, if design (keyword arguments of process_data) is
+        given, 'table_data' with the designed siRNAs. The process_data target
+        defaults to the record id. A record that fails gets 'error' instead.
+        """
+        records = [(record.id, str(record.seq)) for record in SeqIO.parse(query_sequences, "fasta")]
+        record_ids = [record_id for record_id, _ in records]
+        if len(set(record_ids)) != len(record_ids):
+            raise ValueError('Record ids of the batch must be unique!')
+
+        settings = dict(
+            bowtie_db=bowtie_db,
+            rnaplfold_location=rnaplfold_location,
+            bowtie_location=bowtie_location,
+            sirna_size=sirna_size,
+            mismatches=mismatches,
+            design=design,
+            motifs=self.motif_index.motifs,
+            cache=self.cache,
+        )
+        max_workers = max_workers or os.cpu_count() or 1
+        # The records share the CPUs, instead of every one folding on all of them
+        settings['fold_workers'] = max((os.cpu_count() or 1) // max_workers, 1)
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context(BATCH_START_METHOD),
+        ) as executor:
+            futures = [
+                executor.submit(_run_batch_record, record_id, query_sequence, settings)
+                for record_id, query_sequence in records
+            ]
+            try:
+                for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                    record_id, result = future.result()
+                    yield record_id, result, done, len(records)
+            finally:
+                # The caller stopped early, e.g. a closed streamed response
+                for future in futures:
+                    future.cancel()
 
     def process_data(
         self, 
@@ -142,84 +403,423 @@ class SifiPipeline(object):
         remove_damaging_motifs:bool = True,
         contiguous_num:int = None
     ):
-        possible_targets = set(map(lambda x:x[2], self._bowtie_data))
-        no_target = False if target in possible_targets else True
-        json_lst = []
-        for entity in self._bowtie_data:
-            sirna_name = entity[0]
-            strand = entity[1]
-            hit_name = entity[2]
-            query_position = int(sirna_name.split('sirna')[1])
-            sirna_sequence = entity[4]
-
-            if strand == '+':
-
-                # We need the antisense siRNA (c_seq) for the energy
-                # Antisense sequence = sequence position - 2
-                # First two siRNas are ignored
-                # Example, siRNA3 -> Antisense siRNA1 as input for c_seq
-                #antisense_sequence = self.sirna_l[query_position-3][1]
-
-                # Calculate strand selection for each siRNA
-                #if self.strand_check:
-                    # We must ignore the first two siRNAs because we can not calculate free energy
-                if query_position == 1 or query_position == 2:
-                    sirna_sequence_n2 = None
-                    sirna_complement = sirna_sequence
-                else:
-                    sirna_sequence_n2 = self._bowtie_data[query_position-3][4].strip()
-                    sirna_complement = str(Seq(sirna_sequence_n2).reverse_complement().strip())[::-1].upper()
-
-                lunp_data_xmer = self._lunp_data[query_position-1, :].astype(np.float).tolist()[accessibility_window]
-
-                is_efficient,\
-                strand_selection,\
-                end_stability,\
-                sense5_MFE_enegery,\
-                anti_sense5_MFE_enegery,\
-                target_site_accessibility,\
-                thermo_effcicient = \
-                self.calculate_efficiency(
-                    sirna_sequence=sirna_sequence, 
-                    sirna_sequence_n2=sirna_sequence_n2, 
-                    lunp_data_xmer=lunp_data_xmer,
-                    accessibility_check=accessibility_check,
-                    terminal_check=terminal_check,
-                    strand_check=strand_check,
-                    end_check=end_check,
-                    end_stability_treshold=end_stability_treshold,
-                    target_site_accessibility_treshold=target_site_accessibility_treshold,
-                    right_end_type=right_end_type
-                )
+        table = self.select_candidates(
+            target=target,
+            accessibility_check=accessibility_check,
+            accessibility_window=accessibility_window,
+            terminal_check=terminal_check,
+            strand_check=strand_check,
+            end_check=end_check,
+            end_stability_treshold=end_stability_treshold,
+            target_site_accessibility_treshold=target_site_accessibility_treshold,
+            min_gc_range=min_gc_range,
+            max_gc_range=max_gc_range,
+            right_end_type=right_end_type,
+            remove_damaging_motifs=remove_damaging_motifs,
+            contiguous_num=contiguous_num,
+        )
+        self._output_data = self.table_records(table)
+        return self._output_data
 
-                delta_MEF_enegery = anti_sense5_MFE_enegery - sense5_MFE_enegery
-                
-                gc_percentage = SeqUtils.GC(sirna_sequence)
-                SNP_exist = self.is_snp(target, query_position-1, len(sirna_sequence))
-                json_dict = {
-                    "sirna_position": query_position,
-                    "sirna_sequence": sirna_sequence,
-                    "is_efficient": is_efficient,
-                    "SNP_exist": SNP_exist,
-                    "strand_selection": strand_selection,
-                    "end_stability": end_stability,
+    def select_candidates(
+        self, 
+        target:str = None,
+        accessibility_check:bool = True,
+        accessibility_window:str = 8,
+        terminal_check:bool = True,
+        strand_check:bool = True,
+        end_check:bool = True,
+        end_stability_treshold: float = None,
+        target_site_accessibility_treshold: float = None,
+        min_gc_range: float = 40,
+        max_gc_range: float = 60,
+        right_end_type: str = None,
+        remove_damaging_motifs:bool = True,
+        contiguous_num:int = None
+    ):
+        """
+        Score and filter the candidates of the current query and return the
+        selected rows of the candidate table (see process_data).
+        """
+        # One consistent query state, run_record may switch it from another thread
+        with self._lock:
+            table = self.cached_candidate_table(
+                accessibility_window=accessibility_window,
+                right_end_type=right_end_type
+            )
+            self.mark_snps(table, target)
+            self.score_candidates(
+                table,
+                accessibility_check=accessibility_check,
+                terminal_check=terminal_check,
+                strand_check=strand_check,
+                end_check=end_check,
+                end_stability_treshold=end_stability_treshold,
+                target_site_accessibility_treshold=target_site_accessibility_treshold
+            )
+            mask = self.filter_candidates(
+                table,
+                min_gc_range=min_gc_range,
+                max_gc_range=max_gc_range,
+                remove_damaging_motifs=remove_damaging_motifs,
+                contiguous_num=contiguous_num
+            )
+            self._output_data = None
+            self._output_table = table[mask]
+            self._output_orders = {}
+            self._target = target
+            return self._output_table
+
+    def cached_candidate_table(self, accessibility_window=8, right_end_type=None):
+        """
+        Return a copy of the candidate table of the current alignment.
+
+        The table only depends on right_end_type and accessibility_window, so it
+        is built once and reused while those stay the same; changing GC range,
+        thresholds or checks only re-runs score_candidates and filter_candidates.
+        """
+        key = (right_end_type, accessibility_window)
+        if self._candidate_cache is None or self._candidate_cache[0] != key:
+            self._candidate_cache = (key, self.candidate_table(accessibility_window, right_end_type))
+        return self._candidate_cache[1].copy()
+
+    def candidate_table(self, accessibility_window=8, right_end_type=None):
+        """
+        Build the columnar table of all siRNA candidates ('+' strand hits).
+
+        One row per hit, in bowtie order, with the features which do not depend
+        on the filter settings: position, sequence, GC content, 5' end energies,
+        accessibility and damaging motifs. SNPs are marked by mark_snps and
+        the flag columns are filled in by score_candidates.
+        """
+        forward = ~self._bowtie_data.reverse
+        sequences = self._bowtie_data.sequence[forward]
+        size = sequences.itemsize if len(sequences) else 1
+        table = np.zeros(len(sequences), dtype=[
+            ('sirna_position', np.int64),
+            ('sirna_sequence', 'S%d' % size),
+            ('gc_content', np.float64),
+            ('sense5_MFE_enegery', np.float64),
+            ('anti_sense5_MFE_enegery', np.float64),
+            ('accessibility_value', np.float64),
+            ('SNP_exist', np.bool_),
+            ('damaging_motif', np.bool_),
+            ('is_efficient', np.bool_),
+            ('strand_selection', np.bool_),
+            ('end_stability', np.bool_),
+            ('target_site_accessibility', np.bool_),
+            ('thermo_effcicient', np.bool_),
+        ])
+        if not len(sequences):
+            return table
+        table['sirna_position'] = self._bowtie_data.query[forward]
+        table['sirna_sequence'] = sequences
+        positions = table['sirna_position']
+
+        # Energies of the siRNA windows, the antisense siRNA (c_seq) for the
+        # dangling ends is the siRNA two positions upstream
+        sense_energies, antisense_energies = self.window_energies(right_end_type)
+        table['sense5_MFE_enegery'] = sense_energies[positions-1]
+        table['anti_sense5_MFE_enegery'] = antisense_energies[positions-1]
+        table['accessibility_value'] = round_probabilities(self._lunp_data[positions-1, accessibility_window])
+
+        # One scan of the query marks every window containing a damaging motif
+        damaged = self.motif_index.damaged_windows(self._query_sequence.upper(), self._sirna_size)
+        table['damaging_motif'] = damaged[positions-1]
+
+        # Per distinct sequence or position: GC content is rounded like in
+        # the output because the GC range filter is applied to that value
+        sequences, sequence_index = np.unique(table['sirna_sequence'], return_inverse=True)
+        sequences = [sequence.decode() for sequence in sequences]
+        table['gc_content'] = np.array([round(SeqUtils.GC(sequence), 2) for sequence in sequences])[sequence_index]
+        return table
+
+    def mark_snps(self, table, target):
+        """Fill in the SNP_exist column of a candidate table for a target."""
+        if not len(table):
+            return table
+        size = table.dtype['sirna_sequence'].itemsize
+        table['SNP_exist'] = self.SNPs.window_counts(target, table['sirna_position']-1, size) > 0
+        return table
+
+    def score_candidates(
+        self,
+        table,
+        accessibility_check:bool = True,
+        terminal_check:bool = True,
+        strand_check:bool = True,
+        end_check:bool = True,
+        end_stability_treshold: float = None,
+        target_site_accessibility_treshold: float = None
+    ):
+        """
+        Fill in the efficiency flags of a candidate table.
+
+        A siRNA is thermodynamically efficient if all enabled checks pass:
+        strand selection (antisense 5' MFE >= sense 5' MFE), end stability
+        (MFE difference >= end_stability_treshold) and target site
+        accessibility (unpaired probability >= the threshold). With
+        terminal_check the bases at S1 and S19 decide which of them count.
+        """
+        sense = table['sense5_MFE_enegery']
+        antisense = table['anti_sense5_MFE_enegery']
+        table['strand_selection'] = antisense >= sense
+        table['end_stability'] = (antisense - sense) >= end_stability_treshold
+        table['target_site_accessibility'] = table['accessibility_value'] >= target_site_accessibility_treshold
+
+        thermo_effcicient = np.ones(len(table), dtype=np.bool_)
+        if strand_check:
+            thermo_effcicient &= table['strand_selection']
+        if end_check:
+            thermo_effcicient &= table['end_stability']
+        if accessibility_check:
+            thermo_effcicient &= table['target_site_accessibility']
+        table['thermo_effcicient'] = thermo_effcicient
+
+        if terminal_check and len(table):
+            size = table.dtype['sirna_sequence'].itemsize
+            codes = np.ascontiguousarray(table['sirna_sequence']).view(np.uint8).reshape(len(table), size)
+            # A/T at S19 and S1, or C/G at S19 and S1
+            at_s19 = np.isin(codes[:, size-3], (ord('A'), ord('T')))
+            at_s1 = np.isin(codes[:, 1], (ord('A'), ord('T')))
+            gc_s1 = np.isin(codes[:, 1], (ord('G'), ord('C')))
+            if accessibility_check:
+                accessible = table['target_site_accessibility']
+            else:
+                accessible = np.ones(len(table), dtype=np.bool_)
+            table['is_efficient'] = np.where(
+                at_s19,
+                np.where(at_s1, thermo_effcicient, accessible),
+                gc_s1 & thermo_effcicient
+            )
+        else:
+            table['is_efficient'] = thermo_effcicient
+        return table
+
+    def filter_candidates(
+        self,
+        table,
+        min_gc_range: float = 40,
+        max_gc_range: float = 60,
+        remove_damaging_motifs:bool = True,
+        contiguous_num:int = None
+    ):
+        """Return the mask of candidates passing the motif, GC range and contiguous G/C filters."""
+        mask = (max_gc_range > table['gc_content']) & (table['gc_content'] > min_gc_range)
+        if remove_damaging_motifs:
+            mask &= ~table['damaging_motif']
+        # Only for the distinct sequences still left
+        for sequence in np.unique(table['sirna_sequence'][mask]):
+            if not self.gc_contiguous(sequence.decode(), contiguous_num):
+                mask &= table['sirna_sequence'] != sequence
+        return mask
+
+    def table_records(self, table):
+        """Materialize candidate table rows as the dictionaries returned to the UI."""
+        return list(self.iter_records(table))
+
+    def iter_records(self, table, chunk_size=1024):
+        """Yield the dictionaries of table_records one by one, converting chunk_size rows at a time."""
+        for start in range(0, len(table), chunk_size):
+            chunk = table[start:start + chunk_size]
+            columns = {name: chunk[name].tolist() for name in chunk.dtype.names}
+            for i in range(len(chunk)):
+                sense5_MFE_enegery = columns['sense5_MFE_enegery'][i]
+                anti_sense5_MFE_enegery = columns['anti_sense5_MFE_enegery'][i]
+                yield {
+                    "sirna_position": columns['sirna_position'][i],
+                    "sirna_sequence": columns['sirna_sequence'][i].decode(),
+                    "is_efficient": columns['is_efficient'][i],
+                    "SNP_exist": 'Yes' if columns['SNP_exist'][i] else 'No',
+                    "strand_selection": columns['strand_selection'][i],
+                    "end_stability": columns['end_stability'][i],
                     "sense5_MFE_enegery": round(sense5_MFE_enegery,4),
                     "anti_sense5_MFE_enegery": round(anti_sense5_MFE_enegery,4),
-                    "delta_MFE_enegery": round(delta_MEF_enegery,4),
-                    "target_site_accessibility": target_site_accessibility,
-                    "accessibility_value": round(lunp_data_xmer,4),
-                    "gc_content":round(gc_percentage,2),
-                    "thermo_effcicient": thermo_effcicient
+                    "delta_MFE_enegery": round(anti_sense5_MFE_enegery - sense5_MFE_enegery,4),
+                    "target_site_accessibility": columns['target_site_accessibility'][i],
+                    "accessibility_value": round(columns['accessibility_value'][i],4),
+                    "gc_content": columns['gc_content'][i],
+                    "thermo_effcicient": columns['thermo_effcicient'][i]
                 }
-                json_lst.append(json_dict)
 
-        if remove_damaging_motifs:
-             json_lst =  list(filter(lambda x: self.is_damaging(x['sirna_sequence']), json_lst))
-        json_lst = list(filter(lambda x: max_gc_range > x['gc_content']  > min_gc_range, json_lst))
-        json_lst = list(filter(lambda x: self.gc_contiguous(x['sirna_sequence'], contiguous_num), json_lst))
+    def candidate_page(self, page=1, page_size=50, sort_by=None, descending=False, columns=None):
+        """
+        Return the number of selected candidates (of the last select_candidates)
+        and the records of one page of them, sorted by sort_by (a record field
+        or a key of SORT_KEYS, position order without) and with only the given
+        columns. page is 1-based, page_size None gives all candidates.
+        """
+        if page < 1 or (page_size is not None and page_size < 1):
+            raise ValueError('page and page_size must be positive')
+        if columns is not None:
+            unknown = set(columns) - set(self.RECORD_FIELDS)
+            if unknown:
+                raise ValueError('unknown columns: %s' % ', '.join(sorted(unknown)))
+        with self._lock:
+            table = self._output_table
+            if table is None:
+                raise ValueError('no candidates selected, run process_data first')
+            order = self.candidate_order(sort_by, descending) if sort_by else np.arange(len(table))
+
+        if page_size is not None:
+            order = order[(page - 1) * page_size:page * page_size]
+        records = self.iter_records(table[order])
+        if columns is not None:
+            records = ({name: record[name] for name in columns} for record in records)
+        return len(table), list(records)
+
+    def candidate_order(self, sort_by, descending=False):
+        """
+        Return the row order of the selected candidates sorted by sort_by.
+        Ties keep their position order; the orders are kept until the next
+        select_candidates, so paging through a sorted table sorts it once.
+        """
+        key = self.SORT_KEYS.get(sort_by, sort_by)
+        if key not in self.RECORD_FIELDS:
+            raise ValueError('unknown sort key: %s' % sort_by)
+        with self._lock:
+            if (key, descending) not in self._output_orders:
+                table = self._output_table
+                if key == 'delta_MFE_enegery':
+                    values = table['anti_sense5_MFE_enegery'] - table['sense5_MFE_enegery']
+                else:
+                    values = table[key]
+                if key in self.ROUNDED_FIELDS:
+                    # Sorted by the values of the records, so equal values keep position order
+                    values = np.round(values, 4)
+                if descending:
+                    # Stable descending order: sort the reversed values and map back
+                    order = len(values) - 1 - np.argsort(values[::-1], kind='stable')[::-1]
+                else:
+                    order = np.argsort(values, kind='stable')
+                self._output_orders[(key, descending)] = order
+            return self._output_orders[(key, descending)]
 
-        return json_lst
-         # json_lst, eff_sirna_histo.tolist(), main_histo.tolist()
+    def off_target_summary(self, target=None):
+        """
+        Summarize the siRNA hits ('+' strand) of the current query per target
+        as aggregation.OffTargetSummary. Hits on other targets than target
+        (by default the one of the last select_candidates) are off-target;
+        a siRNA is efficient if the last select_candidates selected it as such.
+        """
+        with self._lock:
+            target = self._target if target is None else target
+            if target is None:
+                raise ValueError('no target given, run process_data first')
+            hits = self._bowtie_data
+            forward = ~hits.reverse
+            names = np.array(hits.targets, dtype=np.str_)[hits.target[forward]]
+            positions = hits.query[forward]
+            table = self._output_table
+            if table is None:
+                efficient = np.zeros(len(positions), dtype=np.bool_)
+            else:
+                efficient = np.isin(positions, table['sirna_position'][table['is_efficient']])
+            sirna_size = self._sirna_size
+        return aggregation.OffTargetSummary(names, positions, efficient, names != target, sirna_size)
+
+    def accessibility_profile(self):
+        """
+        Return the lunp matrix of the current query as little endian float32
+        (see read_lunp) and its siRNA size, which is the position of the
+        first row.
+        """
+        with self._lock:
+            return self._lunp_data.astype('<f4', copy=False), self._sirna_size
+
+    def window_energies(self, right_end_type):
+        """
+        Calculate sense and antisense 5' end energies of every siRNA window of the query.
+
+        Window i (0-based) is siRNA i+1. Its dangling ends come from the
+        siRNA two positions upstream (sirna_sequence_n2 in free_energy_dangling_ends),
+        so the first two windows use free_energy3. All windows of a kind are
+        calculated with one free_energy.calculate_free_energy_batch call;
+        windows with other characters than A, C, G and T fall back to the
+        per siRNA methods.
+        """
+        if right_end_type not in ('dangling', 'complement'):
+            raise ValueError("right_end_type must be 'dangling' or 'complement', not {!r}".format(right_end_type))
+        sequence = self._query_sequence.upper()
+        size = self._sirna_size
+        windows = max(len(sequence) - size + 1, 0)
+        codes = free_energy.encode_array(sequence).astype(np.int64)
+        # Other characters are calculated one by one at the end
+        invalid = np.flatnonzero(codes > 3)
+        codes[invalid] = 0
+        complement = 3 - codes
+        sense = np.zeros(windows)
+        antisense = np.zeros(windows)
+        if not windows:
+            return sense, antisense
+
+        def fragments(array, start, stop, step=1, first=0):
+            # Row w holds array[w+start:w+stop:step] for windows w >= first
+            columns = np.arange(start, stop, step)
+            return array[np.arange(first, windows)[:, None] + columns]
+
+        no_n2 = min(2, windows)
+        sense[:no_n2] = free_energy.calculate_free_energy_batch(
+            fragments(codes, 0, self.END_NUCLOTIDES)[:no_n2])
+        antisense[:no_n2] = free_energy.calculate_free_energy_batch(
+            fragments(codes, size-self.OVERHANG-self.END_NUCLOTIDES, size-self.OVERHANG)[:no_n2])
+        if windows > 2:
+            # sense c_seq: complement of the query from one base before the window
+            sense[2:] = free_energy.calculate_free_energy_batch(
+                fragments(codes, 0, self.END_NUCLOTIDES, first=2),
+                fragments(complement, -1, 3, first=2),
+                shifts=1)
+            if right_end_type == 'dangling':
+                antisense[2:] = free_energy.calculate_free_energy_batch(
+                    fragments(complement, size-3, size-6, -1, first=2),
+                    fragments(codes, size-2, size-6, -1, first=2),
+                    shifts=1)
+            if right_end_type == 'complement':
+                antisense[2:] = free_energy.calculate_free_energy_batch(
+                    fragments(complement, size-1, size-5, -1, first=2))
+
+        # Windows touching other characters than A, C, G and T
+        for window in np.unique(np.concatenate([invalid - offset for offset in range(-1, size)])):
+            if 0 <= window < windows:
+                sirna_sequence = sequence[window:window+size]
+                if window < 2:
+                    energies = self.free_energy3(sirna_sequence)
+                else:
+                    sirna_sequence_n2 = sequence[window-2:window-2+size]
+                    energies = self.free_energy_dangling_ends(sirna_sequence, sirna_sequence_n2, right_end_type)
+                sense[window], antisense[window] = energies
+        return sense, antisense
+
+    def align(
+        self,
+        query_sequence=None,
+        bowtie_db=None,
+        bowtie_location=None,
+        sirna_size=None,
+        mismatches=None,
+        ):
+        """
+        Align all siRNA candidates, with the exact match k-mer index of the
+        database if there is one for sirna_size and no mismatches are allowed,
+        with bowtie otherwise. Every distinct candidate is aligned once and its
+        hits are copied to all its positions.
+        """
+        representatives, representative_of = alignment.unique_candidates(query_sequence, sirna_size)
+        index = None
+        if int(mismatches) == 0:
+            index = kmer_index.load_kmer_index(os.path.join(bowtie_location, str(bowtie_db)), sirna_size)
+        if index is not None:
+            hits = index.align(query_sequence, candidates=representatives)
+        else:
+            hits = self.run_bowtie(
+                query_sequence=query_sequence,
+                bowtie_db=bowtie_db,
+                bowtie_location=bowtie_location,
+                sirna_size=sirna_size,
+                mismatches=mismatches,
+                candidates=representatives,
+            )
+        return hits.fan_out(representative_of)
 
     def run_bowtie(
         self,
@@ -228,21 +828,36 @@ class SifiPipeline(object):
         bowtie_location=None,
         sirna_size=None,
         mismatches=None,
+        candidates=None,
         ):
-        """Run BOWTIE alignment."""
-        os.chdir(bowtie_location)
+        """
+        Run BOWTIE alignment (of the given candidate numbers only, if any).
+
+        With a cache, the hits are stored under the query, candidates,
+        mismatches and the size and mtime of the database files, so they are
+        reused until the database is rebuilt.
+        """
+        key = None
+        if self.cache is not None:
+            database = self.database_fingerprint(bowtie_location, bowtie_db)
+            if database:
+                key = self.cache.key(
+                    'bowtie', query_sequence.upper(), sirna_size, int(mismatches), database,
+                    None if candidates is None else np.asarray(candidates, dtype=np.int64).tobytes()
+                )
+                cached = self.cache.get(key)
+                if cached is not None:
+                    return alignment.AlignmentHits.from_arrays(cached)
+
         # -a report all alignments per read;
         # -n max mismatches in seed
         # -y try hard to find valid alignments, at the expense of speed
         # -x index name
-        # -f query input files are (multi-)FASTA .fa/.mfa
-        fd, out_path    = tempfile.mkstemp()
-        fdd, input_path = tempfile.mkstemp(suffix=".fasta")
-
-        with os.fdopen(fdd, mode="r+") as fp:
-            for i in range(0, len(query_sequence)-sirna_size+1):
-                fp.write('> sirna'+str(i+1)+'\n')
-                fp.write(query_sequence[i:i+sirna_size].upper() + '\n')
+        # -f query input files are (multi-)FASTA .fa/.mfa, '-' reads them from stdin
+        # --mm map the index instead of reading it, it is kept resident by self.indexes
+        # The candidates are written to bowtie's stdin by a separate thread while
+        # the hits are parsed from its stdout, so neither side is kept in full as text
+        index_args = self.indexes.acquire(bowtie_location, bowtie_db)
         try:
             process = subprocess.Popen([
                 "bowtie", 
@@ -250,24 +865,39 @@ class SifiPipeline(object):
                 "-v", 
                 str(mismatches),  
                 "-y",
+                *index_args,
                 bowtie_db, 
                 "-f",
-                input_path, 
-                out_path
-            ])
-            process.wait()
-        except BaseException as error:
-            raise 'An exception occurred while execution of Bowtie: {}'.format(error)
-
-
-        with os.fdopen(fd) as fp:
-            bowtie_data = fp.readlines()
-            bowtie_data = list(map(lambda x: x.strip().split('\t'), bowtie_data))
-
-        os.unlink(out_path)
-        os.unlink(input_path)
+                "-",
+            ], stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=bowtie_location)
+        except OSError as error:
+            raise RuntimeError('An exception occurred while execution of Bowtie: {}'.format(error))
+
+        writer = threading.Thread(
+            target=alignment.write_candidates,
+            args=(process.stdin, query_sequence, sirna_size, candidates),
+            daemon=True,
+        )
+        writer.start()
+        with process.stdout:
+            bowtie_data = alignment.AlignmentHits(alignment.parse_bowtie_lines(process.stdout))
+        writer.join()
+        if process.wait() != 0:
+            raise RuntimeError('An exception occurred while execution of Bowtie: exit status {}'.format(process.returncode))
+        if key is not None:
+            self.cache.put(key, bowtie_data.to_arrays())
         return bowtie_data
 
+    def database_fingerprint(self, bowtie_location, bowtie_db):
+        """Return (file, size, mtime) of all index files of a bowtie database (empty if none)."""
+        base = os.path.join(bowtie_location, str(bowtie_db))
+        fingerprint = []
+        for ending in indexes.BOWTIE_ENDINGS:
+            if os.path.exists(base + ending):
+                stat = os.stat(base + ending)
+                fingerprint.append((os.path.abspath(base + ending), stat.st_size, stat.st_mtime_ns))
+        return tuple(fingerprint)
+
     def run_rnaplfold(
         self,
         query_name=None, 
@@ -296,8 +926,51 @@ class SifiPipeline(object):
         followed by the probability that i is unpaired, [i-1..i] is unpaired [i-2..i] 
         is unpaired and so on to the probability that [i-x+1..i] is unpaired.
         '''
-        os.chdir(rnaplfold_location)
 
+        if self.cache is not None:
+            key = self.cache.key('lunp', query_sequence, self.WINSIZE, self.SPAN, self.TEMPERATURE, sirna_size)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached['lunp']
+            lunp_data = self.fold(query_sequence, sirna_size)
+            self.cache.put(key, {'lunp': lunp_data})
+            return lunp_data
+        return self.fold(query_sequence, sirna_size)
+
+    def fold(self, query_sequence, sirna_size):
+        """
+        Fold query_sequence with RNAplfold, in chunks on at most fold_workers
+        processes at a time if it is long.
+        """
+        if len(query_sequence) <= self.PLFOLD_CHUNK_SIZE:
+            return self.fold_sequence(query_sequence, sirna_size)
+
+        cores, chunks = self.fold_chunks(len(query_sequence), sirna_size)
+        workers = min(self.fold_workers or os.cpu_count() or 1, len(chunks))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            folded = list(executor.map(
+                lambda chunk: self.fold_sequence(query_sequence[chunk[0]:chunk[1]], sirna_size),
+                chunks
+            ))
+        return stitch_lunp(cores, chunks, folded, sirna_size)
+
+    def fold_chunks(self, length, sirna_size):
+        """
+        Split a sequence of length into the cores of PLFOLD_CHUNK_SIZE and the
+        overlapping chunks folded for them, as (start, end) pairs.
+
+        A row only depends on the WINSIZE windows around its region, so with
+        margins of WINSIZE+sirna_size the rows of a chunk's core are the ones
+        of the whole sequence.
+        """
+        margin = self.WINSIZE + sirna_size
+        cores = [(start, min(start + self.PLFOLD_CHUNK_SIZE, length))
+                 for start in range(0, length, self.PLFOLD_CHUNK_SIZE)]
+        chunks = [(max(start - margin, 0), min(end + margin, length)) for start, end in cores]
+        return cores, chunks
+
+    def fold_sequence(self, sequence, sirna_size):
+        """Run RNAplfold on one sequence and return its lunp matrix (see read_lunp)."""
         with tempfile.TemporaryDirectory() as fp:
             prc_stdout = subprocess.PIPE
             try:
@@ -310,16 +983,14 @@ class SifiPipeline(object):
                     stdin=subprocess.PIPE, 
                     stdout=prc_stdout, 
                     cwd=fp)
-                prc.stdin.write(query_sequence.encode())
+                prc.stdin.write(sequence.encode())
                 prc.stdin.write('\n'.encode())
                 prc.communicate()
-            except RuntimeError as error:
-                raise 'An exception occurred: {}'.format(error)
+            except OSError as error:
+                raise RuntimeError('An exception occurred: {}'.format(error))
 
             lunp_file = os.path.join(fp, 'plfold_lunp')
-            lunp_data = np.loadtxt(lunp_file, dtype='str')
-            # Delete first lines self.sirna_size-1 because they are not complete
-            lunp_data = np.delete(lunp_data, np.r_[:sirna_size-1], 0)
+            lunp_data = read_lunp(lunp_file, sirna_size)
 
         return lunp_data
 
@@ -334,12 +1005,16 @@ class SifiPipeline(object):
             fname, ext = os.path.splitext(path)
             if ext == '':
                 path = fname + '.csv'
-            csv_columns = list(self._output_data[0].keys())
+            output_data = self._output_data
+            if output_data is None:
+                # Streamed results, see select_candidates
+                output_data = self.table_records(self._output_table)
+            csv_columns = list(output_data[0].keys())
             try:
                 with open(path, 'w') as csvfile:
                     writer = csv.DictWriter(csvfile, fieldnames=csv_columns)
                     writer.writeheader()
-                    for data in self._output_data:
+                    for data in output_data:
                         writer.writerow(data)
             except IOError:
                 print("I/O error")
@@ -359,9 +1034,9 @@ class SifiPipeline(object):
         # Anitsense5_MFE
         antisense_five_seq = sirna_sequence[len(sirna_sequence)-self.OVERHANG-self.END_NUCLOTIDES:len(sirna_sequence)-self.OVERHANG]
 
-        #sense5_MFE_enegery = free_energy.calculate_free_energy(sense_five_seq)
-        sense5_MFE_enegery = free_energy.calculate_free_energy(sense_five_seq)
-        anti_sense5_MFE_enegery = free_energy.calculate_free_energy(antisense_five_seq)
+        engine = free_energy.get_engine()
+        sense5_MFE_enegery = engine.delta_g(sense_five_seq)
+        anti_sense5_MFE_enegery = engine.delta_g(antisense_five_seq)
 
         #print sense_five_seq, sense5_MFE_enegery, antisense_five_seq, anti_sense5_MFE_enegery
         return sense5_MFE_enegery, anti_sense5_MFE_enegery
@@ -378,217 +1053,57 @@ class SifiPipeline(object):
         #sense_c_seq = Seq(sirna_sequence_n2).reverse_complement().strip()[self.sirna_size-6:self.sirna_size-1]
         sense_c_seq = Seq(sirna_sequence_n2).reverse_complement().strip()[len(sirna_sequence)-5:len(sirna_sequence)-1]
 
-        sense5_MFE_enegery = free_energy.calculate_free_energy(sense_five_seq, check=True, strict=True, c_seq=sense_c_seq[::-1], shift=1)
+        engine = free_energy.get_engine()
+        sense5_MFE_enegery = engine.delta_g(sense_five_seq, c_seq=sense_c_seq[::-1], shift=1)
 
 
         if right_end_type == 'dangling':
             # Anitsense5_MFE for sifi siRNA not zhangbing siRNA
             antisense_five_seq = Seq(sirna_sequence_n2).reverse_complement().strip()[self.SIRNA_START_POSITION:self.END_NUCLOTIDES]
             antisense_c_seq = sirna_sequence[len(sirna_sequence)-5:len(sirna_sequence)-1]
-            anti_sense5_MFE_enegery = free_energy.calculate_free_energy(antisense_five_seq, check=True, strict=True, c_seq=antisense_c_seq[::-1], shift=1)
+            anti_sense5_MFE_enegery = engine.delta_g(antisense_five_seq, c_seq=antisense_c_seq[::-1], shift=1)
 
 
         if right_end_type == 'complement':
             antisense_five_seq = Seq(sirna_sequence[-4::]).reverse_complement()
-            anti_sense5_MFE_enegery = free_energy.calculate_free_energy(antisense_five_seq)
+            anti_sense5_MFE_enegery = engine.delta_g(antisense_five_seq)
 
             #print 'sense ',  sirna_sequence, sense_five_seq, sense_c_seq[::-1]
             # print 'G ', sense5_MFE_enegery
 
             #print 'antisense ', sirna_sequence_n2, antisense_five_seq, antisense_c_seq[::-1]
-            anti_sense5_MFE_enegery = free_energy.calculate_free_energy(antisense_five_seq)
             #print 'G ', anti_sense5_MFE_enegery
 
         return sense5_MFE_enegery, anti_sense5_MFE_enegery
 
-    def strand_selection(self, sirna_sequence, sirna_sequence_n2, right_end_type):
-        """Returns whether the strand will be selected (True) or not (False) based on energy rules."""
-        # For siRNA n>3 we calculate with dangling ends
-        if sirna_sequence_n2 != None:
-            sense5_MFE_enegery, anti_sense5_MFE_enegery = self.free_energy_dangling_ends(sirna_sequence, sirna_sequence_n2, right_end_type)
-        else:
-            #pass
-            # For the first two siRNAs no dangling ends
-            sense5_MFE_enegery, anti_sense5_MFE_enegery = self.free_energy3(sirna_sequence)
-
-        if anti_sense5_MFE_enegery >= sense5_MFE_enegery:
-            strand_selection = True
-        else:
-            strand_selection = False
-        #print "G_S/G_AS ", sense5_MFE_enegery, anti_sense5_MFE_enegery
-        return strand_selection
-
-    def end_stability(self, sirna_sequence, sirna_sequence_n2, end_stability_treshold, right_end_type):
-        """Calculate whether the end stability is higher or equal threshold (default=1).
-           Return True if yes and False if it is lower."""
-        # For siRNA n>3 we calculate with dangling ends
-        if sirna_sequence_n2 != None:
-            sense5_MFE_enegery, anti_sense5_MFE_enegery = self.free_energy_dangling_ends(sirna_sequence, sirna_sequence_n2, right_end_type)
-        else:
-            #pass
-            # For the first two siRNAs no dangling ends
-            sense5_MFE_enegery, anti_sense5_MFE_enegery = self.free_energy3(sirna_sequence)
-
-        # End stability
-        if (anti_sense5_MFE_enegery - sense5_MFE_enegery) >= end_stability_treshold:
-            end_stability = True
-        else:
-            end_stability = False
-        return end_stability, sense5_MFE_enegery, anti_sense5_MFE_enegery
-
-    def pair_probability(self, lunp_data_xmer, ts_accessibility_treshold):
-        """Calculates whether the pair probability the siRNA at a certain window (default 8) is higher or equal
-           the threshold (default=0.1)
-           Return True if yes and False if it is lower."""
-        # Get pair probability of the accessibility window (chosen by user) of siRNA
-        #print "accessibility ", lunp_data_xmer
-        if lunp_data_xmer >= ts_accessibility_treshold:
-            return True
-        else:
-            return False
-
-    def check_efficient(
-        self, 
-        strand_check:bool = True, 
-        end_check: bool = True,  
-        accessibility_check: bool = True, 
-        strand_selection: bool = True, 
-        end_stability: bool = True, 
-        target_site_accessibility: bool = True
-    ):
-        """Calculates whether a siRNA is efficient or not. Default priority rules (if checked by user):
-           1. Strand selection must be True.
-           2. End stability must be higher or equal threshold (default=1).
-           3. Pair probability (lunp data) of xmer (chosen by user, default 8) must be higher or equal threshold (default=0.1).
-           If all rules apply, a siRNA is efficient."""
-
-        is_efficient = None
-        if strand_check and end_check and accessibility_check:
-            if strand_selection and end_stability and target_site_accessibility:
-                is_efficient = True
-            else:
-                is_efficient = False
-        if strand_check and end_check and not accessibility_check:
-            if strand_selection and end_stability:
-                is_efficient = True
-            else:
-                is_efficient = False
-        if strand_check and accessibility_check and not end_check:
-            if strand_selection and target_site_accessibility:
-                is_efficient = True
-            else:
-                is_efficient = False
-        if end_check and accessibility_check and not strand_check:
-            if end_stability and target_site_accessibility:
-                is_efficient = True
-            else:
-                is_efficient = False
-        if strand_check and not end_check and not accessibility_check:
-            if strand_selection:
-                is_efficient = True
-            else:
-                is_efficient = False
-        if end_check and not strand_check and not accessibility_check:
-            if end_stability:
-                is_efficient = True
-            else:
-                is_efficient = False
-        if accessibility_check and not strand_check and not end_check:
-            if target_site_accessibility:
-                is_efficient = True
-            else:
-                is_efficient = False
-        if not accessibility_check and not strand_check and not end_check:
-            is_efficient = True
-
-        return is_efficient
-
-    def is_damaging(self,sirna_sequence):
-        damaging_motifs = ["GGAATGT", "GAGGTAG", "AGGTAGT", "ACCCTGT", "AGCAGCA", "GCAGCAT", "GTGCAAA", "AGTGCAA", "CAGTGCA"  , "AAGTGCT"  , "AAAGTGC"    , "TCACATT", "ATTGCAC", "TCAAGTA", "TCACAGT", "CACAGTG", "AGCACCA", "GTAAACA", "GGCAGTG", "ACCCGTA", "TAAGGCA", "AAGGCAC", "CCCTGAG", "TGGTCCC", "ATGGCTT", "ACATTCA", "TGACCTA", "CCAGTGT", "AACACTG", "AATACTG", "TCCCTTT", "GCTACAT", "GGAAGAC", "CTTTGGT", "AAGGTGC", "AGCTTAT", "AGCTGCC", "GGCTCAG", "TGCATTG", "ACAGTAC", "GGAGTGT", "CGTACCG", "ATTGCTT", "GCTGGTG", "GTGGTTT", "GTAGTGT", "ACAGTAT", "GAGAACT", "TGCATAG", "TAATGCT", "ATGGCAC", "GGACGGA", "CGTGTCT", "GATATGT", "GTAACAG", "TGAAATG", "CCTTCAT", "AATCTCA", "ACTGCAT", "TGTGCTT", "GATTGTC", "GTCAGTT", "TTGTTCG", "TGTGT", "GTGGTTGTT"]
-
-        result = [*filter(lambda x: x in sirna_sequence or str(Seq(x).reverse_complement()) in sirna_sequence, damaging_motifs)]
-
-        #Authored by Zero Keng
-        # damaging_motif = False
-        # for motif in self.damaging:
-        #     c_motif = str(Seq(motif).reverse_complement())
-        #     if motif in sirna_sequence or c_motif in sirna_sequence:
-        #         damaging_motif = True
-        #         continue
-
-        # return damaging_motif
-        return not bool(result)
-
-    def is_snp(self, hit_name, start_position, sirna_size):
-        snp_sum = 0
-
-        if hit_name in self.SNPs.keys(): 
-            for snp in self.SNPs[hit_name]:
-                if int(start_position) <= int(snp) <= int(start_position) + int(sirna_size) - 1:
-                    snp_sum += 1
-                else:
-                    pass
-            return 'Yes' if bool(snp_sum) else 'No' 
-        else:
-            return 'No'   
-
-    def calculate_efficiency(
-        self,
-        sirna_sequence: str = None,
-        sirna_sequence_n2: str = None,
-        lunp_data_xmer: int = None,
-        accessibility_check: bool = True,
-        terminal_check: bool = True,
-        strand_check: bool = True,
-        end_check: bool = True,
-        end_stability_treshold: float = None,
-        target_site_accessibility_treshold: float = None,
-        right_end_type: str = None
-    ):
-        """
-        """
-        is_efficient = None 
-        sirna_size = len(sirna_sequence)
-        strand_selection = self.strand_selection(sirna_sequence, sirna_sequence_n2, right_end_type)
-        end_stability, sense5_MFE_enegery, anti_sense5_MFE_enegery = self.end_stability(sirna_sequence, sirna_sequence_n2, end_stability_treshold, right_end_type)
-        target_site_accessibility = self.pair_probability(lunp_data_xmer, target_site_accessibility_treshold)
-        thermo_effcicient = self.check_efficient(
-            strand_check = strand_check, 
-            end_check = end_check,  
-            accessibility_check = accessibility_check, 
-            strand_selection= strand_selection, 
-            end_stability = end_stability, 
-            target_site_accessibility = target_site_accessibility
+    def load_motifs(self, path):
+        """Use the damaging motifs listed in a file instead of motifs.DAMAGING_MOTIFS."""
+        self.motif_index = motifs.MotifIndex.from_file(path)
+        self._candidate_cache = None
+
+
+def _run_batch_record(record_id, query_sequence, settings):
+    """Process pool worker of SifiPipeline.iter_batch for one record."""
+    sifi = SifiPipeline(cache=settings['cache'])
+    sifi.fold_workers = settings['fold_workers']
+    if settings['motifs'] != sifi.motif_index.motifs:
+        sifi.motif_index = motifs.MotifIndex(settings['motifs'])
+    try:
+        sifi.SNPs = snps.load_snp_index(os.path.join(settings['bowtie_location'], snps.SNP_STORE))
+        bowtie_data, lunp_data = sifi.run_record(
+            query_name=record_id,
+            query_sequence=query_sequence,
+            bowtie_db=settings['bowtie_db'],
+            rnaplfold_location=settings['rnaplfold_location'],
+            bowtie_location=settings['bowtie_location'],
+            sirna_size=settings['sirna_size'],
+            mismatches=settings['mismatches'],
         )
-        if terminal_check:
-            if sirna_sequence[sirna_size-3] == 'A' or sirna_sequence[sirna_size-3] == 'T':
-                #print "A/T at S19"
-                if sirna_sequence[1] == 'A' or sirna_sequence[1] == 'T':
-                    #print "A/T at S1"
-                    if thermo_effcicient:
-                        is_efficient = True
-                    else:
-                        is_efficient = False
-                else:
-                    if accessibility_check:
-                        if target_site_accessibility:
-                            is_efficient = True
-                        else:
-                            is_efficient = False
-                    else:
-                        is_efficient = True
-            else:
-                if sirna_sequence[1] == 'G' or sirna_sequence[1] == 'C':
-                    #print "C/G at S1"
-                    if thermo_effcicient:
-                        is_efficient = True
-                    else:
-                        is_efficient = False
-                else:
-                    is_efficient = False
-        else:
-            if thermo_effcicient:
-                is_efficient = True
-            else:
-                is_efficient = False
-        return is_efficient, strand_selection, end_stability, sense5_MFE_enegery, anti_sense5_MFE_enegery, target_site_accessibility, thermo_effcicient
+        result = {'pipeline': sifi, 'align_data': bowtie_data, 'lunp_data': lunp_data}
+        if settings['design'] is not None:
+            design = dict(settings['design'])
+            design.setdefault('target', record_id)
+            result['table_data'] = sifi.process_data(**design)
+    except Exception as error:
+        result = {'error': str(error)}
+    return record_id, result
@@ -0,0 +1,185 @@
+import glob
+import os
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class PipelineRegistry(object):
+    """
+    Pipelines (with their alignment and lunp data) of several designs, by id.
+
+    The pipelines are kept in memory, least recently used ones are evicted
+    once their memory (SifiPipeline.memory_size) exceeds max_bytes; the most
+    recently used one always stays. With a spill_directory evicted pipelines
+    are pickled there and loaded back when they are asked for again. The
+    spill directory is bounded by max_spilled files and max_spill_bytes, the
+    oldest spilled pipelines are dropped first, and pipelines not used for
+    max_age seconds expire. Spill files left by a previous registry cannot
+    be reached and are removed when the registry is created.
+
+    Parameters
+    ----------
+    max_bytes
+            memory bound of the pipelines kept in memory
+    spill_directory
+            folder for evicted pipelines, they are dropped without one
+    max_spilled
+            number of pipelines kept in the spill directory
+    max_spill_bytes
+            size bound of the spill directory
+    max_age
+            seconds after their last use the pipelines are dropped
+    """
+
+    def __init__(self, max_bytes=512 * 1024**2, spill_directory=None, max_spilled=64,
+                 max_spill_bytes=4 * 1024**3, max_age=24 * 3600):
+        self.max_bytes = max_bytes
+        self.spill_directory = None if spill_directory is None else str(spill_directory)
+        self.max_spilled = max_spilled
+        self.max_spill_bytes = max_spill_bytes
+        self.max_age = max_age
+        self._pipelines = OrderedDict()
+        # Evicted pipelines being pickled, still served from memory meanwhile
+        self._spilling = {}
+        # key: (path, size), least recently used first
+        self._spilled = OrderedDict()
+        self._used = {}
+        self._lock = threading.Lock()
+        if self.spill_directory is not None:
+            os.makedirs(self.spill_directory, exist_ok=True)
+            for path in glob.glob(os.path.join(self.spill_directory, '*.pickle')):
+                self._remove_file(path)
+
+    def add(self, pipeline):
+        """Register a pipeline and return its id."""
+        key = uuid.uuid4().hex
+        with self._lock:
+            self._expire()
+            self._pipelines[key] = pipeline
+            self._used[key] = time.time()
+            evicted = self._evict()
+        self._spill(evicted)
+        return key
+
+    def get(self, key):
+        """Return the pipeline of key, or None for an unknown or expired key."""
+        if key is None:
+            return None
+        loaded = None
+        while True:
+            with self._lock:
+                self._expire()
+                if key in self._spilling:
+                    self._pipelines[key] = self._spilling.pop(key)
+                elif key in self._spilled and loaded is not None and self._spilled[key][0] == loaded[0]:
+                    if loaded[1] is None:
+                        # The spill file was removed by someone else
+                        self._forget(key)
+                        return None
+                    self._pipelines[key] = loaded[1]
+                    self._remove_file(self._spilled.pop(key)[0])
+                if key in self._pipelines:
+                    self._pipelines.move_to_end(key)
+                    self._used[key] = time.time()
+                    pipeline = self._pipelines[key]
+                    evicted = self._evict()
+                    break
+                if key not in self._spilled:
+                    return None
+                path = self._spilled[key][0]
+            # Unpickled outside the lock; when another request loads, spills
+            # again or removes the pipeline meanwhile the lookup is repeated
+            try:
+                with open(path, 'rb') as f:
+                    loaded = (path, pickle.load(f))
+            except FileNotFoundError:
+                loaded = (path, None)
+        self._spill(evicted)
+        return pipeline
+
+    def remove(self, key):
+        """Forget the pipeline of key."""
+        with self._lock:
+            self._forget(key)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._pipelines or key in self._spilling or key in self._spilled
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pipelines) + len(self._spilling) + len(self._spilled)
+
+    def _evict(self):
+        """Take the least recently used pipelines over max_bytes out of memory (under the lock)."""
+        # Sizes change while a pipeline is used (e.g. its candidate table), so
+        # they are measured on every eviction
+        sizes = {key: pipeline.memory_size() for key, pipeline in self._pipelines.items()}
+        total = sum(sizes.values())
+        evicted = []
+        while total > self.max_bytes and len(self._pipelines) > 1:
+            key, pipeline = self._pipelines.popitem(last=False)
+            total -= sizes[key]
+            if self.spill_directory is None:
+                self._used.pop(key, None)
+            else:
+                self._spilling[key] = pipeline
+                evicted.append((key, pipeline))
+        return evicted
+
+    def _spill(self, evicted):
+        """Pickle evicted pipelines (outside the lock) and bound the spill directory."""
+        for key, pipeline in evicted:
+            # Every spill gets its own file, an earlier one may still be read
+            path = os.path.join(self.spill_directory, '{}-{}.pickle'.format(key, uuid.uuid4().hex[:8]))
+            try:
+                with open(path, 'wb') as f:
+                    pickle.dump(pipeline, f, protocol=pickle.HIGHEST_PROTOCOL)
+            except OSError:
+                # No room to spill, the pipeline is dropped
+                self._remove_file(path)
+                with self._lock:
+                    if self._spilling.get(key) is pipeline:
+                        self._forget(key)
+                continue
+            with self._lock:
+                # The pipeline may have been used again or removed meanwhile
+                if self._spilling.get(key) is pipeline:
+                    del self._spilling[key]
+                    self._spilled[key] = (path, os.path.getsize(path))
+                else:
+                    self._remove_file(path)
+        if evicted:
+            with self._lock:
+                self._expire()
+                spill_bytes = sum(size for _, size in self._spilled.values())
+                while self._spilled and (len(self._spilled) > self.max_spilled or spill_bytes > self.max_spill_bytes):
+                    key = next(iter(self._spilled))
+                    spill_bytes -= self._spilled[key][1]
+                    self._forget(key)
+
+    def _expire(self):
+        """Drop the pipelines not used for max_age seconds (under the lock)."""
+        if self.max_age is None:
+            return
+        limit = time.time() - self.max_age
+        for key in [key for key, used in self._used.items() if used < limit]:
+            self._forget(key)
+
+    def _forget(self, key):
+        self._pipelines.pop(key, None)
+        self._spilling.pop(key, None)
+        self._used.pop(key, None)
+        path, _ = self._spilled.pop(key, (None, None))
+        if path is not None:
+            self._remove_file(path)
+
+    @staticmethod
+    def _remove_file(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,145 @@
+import json
+import os
+import struct
+import tempfile
+import threading
+
+import numpy as np
+
+
+class SnpStore(object):
+    """
+    Memory-mapped binary SNP store written by convert_snp_json.
+
+    The SNP positions of every transcript are sorted, so overlaps are
+    counted with a binary search instead of scanning every SNP of the
+    transcript, for one siRNA (count) or all windows at once
+    (window_counts).
+
+    Layout (little endian): the header '<8sQQQ' (magic, number of
+    transcripts, size of the names block, number of positions), the
+    transcript names separated by newlines (UTF-8), padding to 8 bytes,
+    uint64 offsets (one more than transcripts) and the sorted uint32
+    positions of all transcripts one after another. Only the offsets and
+    the positions of the transcripts looked up are paged in.
+
+    Parameters
+    ----------
+    path
+            location of the store file
+    """
+
+    MAGIC = b'SIFISNP1'
+    HEADER = struct.Struct('<8sQQQ')
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, transcripts, names_size, total = self.HEADER.unpack(f.read(self.HEADER.size))
+            if magic != self.MAGIC:
+                raise ValueError(f'{path} is not a SNP store file')
+            names = f.read(names_size).decode('utf-8').split('\n') if transcripts else []
+        offsets_start = _align(self.HEADER.size + names_size)
+        self._names = {name: i for i, name in enumerate(names)}
+        self._offsets = np.memmap(path, dtype='<u8', mode='r', offset=offsets_start, shape=(transcripts + 1,))
+        if total:
+            self._all_positions = np.memmap(path, dtype='<u4', mode='r',
+                                            offset=offsets_start + 8 * (transcripts + 1), shape=(total,))
+        else:
+            self._all_positions = np.zeros(0, dtype='<u4')
+
+    def __reduce__(self):
+        # Pickle the location, not the mapped data
+        return (SnpStore, (self.path,))
+
+    def __contains__(self, transcript):
+        return transcript in self._names
+
+    def keys(self):
+        return self._names.keys()
+
+    def positions(self, transcript):
+        """Return the sorted SNP positions of a transcript (empty if unknown)."""
+        i = self._names.get(transcript)
+        if i is None:
+            return np.zeros(0, dtype=np.int64)
+        return self._all_positions[int(self._offsets[i]):int(self._offsets[i + 1])].astype(np.int64)
+
+    def count(self, transcript, start_position, size):
+        """Return the number of SNPs in [start_position, start_position+size-1]."""
+        return int(self.window_counts(transcript, [int(start_position)], int(size))[0])
+
+    def window_counts(self, transcript, start_positions, size):
+        """Return the number of SNPs in every window [start, start+size-1] of start_positions."""
+        positions = self.positions(transcript)
+        starts = np.asarray(start_positions, dtype=np.int64)
+        return np.searchsorted(positions, starts + size - 1, side='right') - np.searchsorted(positions, starts, side='left')
+
+
+def _align(size, alignment=8):
+    return (size + alignment - 1) // alignment * alignment
+
+
+def convert_snp_json(json_path, store_path):
+    """Convert a snp.json file into a SnpStore file."""
+    with open(json_path) as f:
+        snps = json.load(f)
+    names = list(snps.keys())
+    if any('\n' in name for name in names):
+        raise ValueError('transcript names must not contain newlines')
+    names_block = '\n'.join(names).encode('utf-8')
+    positions = [np.sort(np.array([int(snp) for snp in snps[name]], dtype=np.int64)) for name in names]
+    offsets = np.zeros(len(names) + 1, dtype='<u8')
+    offsets[1:] = np.cumsum([len(p) for p in positions])
+    all_positions = np.concatenate(positions) if positions else np.zeros(0, dtype=np.int64)
+    if len(all_positions) and (all_positions.min() < 0 or all_positions.max() > np.iinfo(np.uint32).max):
+        raise ValueError('SNP positions must fit into unsigned 32 bit integers')
+
+    # Write next to the target and move it in place, so readers never see half
+    # a file and a concurrent conversion only decides which complete file wins
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(store_path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(SnpStore.HEADER.pack(SnpStore.MAGIC, len(names), len(names_block), len(all_positions)))
+            f.write(names_block)
+            f.write(b'\0' * (_align(SnpStore.HEADER.size + len(names_block)) - SnpStore.HEADER.size - len(names_block)))
+            f.write(offsets.tobytes())
+            f.write(all_positions.astype('<u4').tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp files are only readable by their owner
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, store_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return store_path
+
+
+# File name of the store in the Bowtie folder
+SNP_STORE = 'snp.bin'
+
+_INDEXES = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+def load_snp_index(path):
+    """
+    Return the shared SnpStore of the store file at path.
+
+    The store is written offline from snp.json (manage.py convert_snps),
+    requests only memory-map it. A store replaced by a new conversion is
+    mapped again.
+    """
+    with _INDEXES_LOCK:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            raise ValueError(f'try to open SNP store at {path}, failed! Convert snp.json with manage.py convert_snps.') from None
+        # os.replace gives a new inode, so a new conversion is never taken for the old one
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        cached = _INDEXES.get(path)
+        if cached is None or cached[0] != key:
+            cached = (key, SnpStore(path))
+            _INDEXES[path] = cached
+        return cached[1]
@@ -1,3 +1,1037 @@
-from django.test import TestCase
+import base64
+import concurrent.futures
+import datetime
+import io
+import json
+import os
+import pickle
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+from collections import Counter
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from Bio.Seq import Seq
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import RequestFactory, SimpleTestCase, TransactionTestCase
+from django.utils import timezone
+
+from analysis import alignment
+from analysis import cache
+from analysis import database_helpers
+from analysis import free_energy
+from analysis import general_helpers
+from analysis import indexes
+from analysis import jobs
+from analysis import kmer_index
+from analysis import motifs
+from analysis import pipeline
+from analysis import registry
+from analysis import snps
+from analysis import views
+from analysis.models import Job
+
+TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata')
+
+
+def random_sequence(rng, length, alphabet='ACGT'):
+    return ''.join(rng.choice(alphabet) for _ in range(length))
+
+
+def complement(sequence):
+    return str(Seq(sequence).complement())
+
+
+def reverse_complement(sequence):
+    return str(Seq(sequence).reverse_complement())
+
+
+class FreeEnergyEngineTests(SimpleTestCase):
+    """The energy engine against calculate_free_energy."""
+
+    def setUp(self):
+        self.rng = random.Random(1)
+        # No cache, every value is calculated by the engine
+        self.engine = free_energy.EnergyEngine()
+
+    def test_delta_g(self):
+        for length in range(2, 9):
+            for _ in range(30):
+                seq = random_sequence(self.rng, length)
+                self.assertEqual(self.engine.delta_g(seq), free_energy.calculate_free_energy(seq), seq)
+
+    def test_dangling_ends(self):
+        # Fragments as in SifiPipeline.window_energies: the complement
+        # starts one base before the siRNA
+        for _ in range(200):
+            region = random_sequence(self.rng, 4)
+            seq, c_seq = region[1:], complement(region)
+            self.assertEqual(
+                self.engine.delta_g(seq, c_seq=c_seq, shift=1),
+                free_energy.calculate_free_energy(seq, c_seq=c_seq, shift=1),
+                (seq, c_seq)
+            )
+
+    def test_other_characters(self):
+        for seq in ('ANG', 'CNNT', 'GC'):
+            self.assertEqual(self.engine.delta_g(seq, strict=False), free_energy.calculate_free_energy(seq, strict=False))
+
+
+class BatchEnergyTests(SimpleTestCase):
+    """calculate_free_energy_batch and SifiPipeline.window_energies against the per fragment calculation."""
+
+    def setUp(self):
+        self.rng = random.Random(2)
+
+    def test_batch(self):
+        regions = [random_sequence(self.rng, 4) for _ in range(100)]
+        seqs = [region[1:] for region in regions]
+        c_seqs = [complement(region) for region in regions]
+        encoded = np.array([free_energy.encode_array(seq) for seq in seqs])
+        c_encoded = np.array([free_energy.encode_array(c_seq) for c_seq in c_seqs])
+        self.assertEqual(
+            free_energy.calculate_free_energy_batch(encoded).tolist(),
+            [free_energy.calculate_free_energy(seq) for seq in seqs]
+        )
+        self.assertEqual(
+            free_energy.calculate_free_energy_batch(encoded, c_encoded, shifts=1).tolist(),
+            [free_energy.calculate_free_energy(seq, c_seq=c_seq, shift=1) for seq, c_seq in zip(seqs, c_seqs)]
+        )
+
+    def test_window_energies(self):
+        sifi = pipeline.SifiPipeline()
+        sequence = random_sequence(self.rng, 200)
+        sifi._query_sequence = sequence
+        sifi._sirna_size = 21
+        for right_end_type in ('dangling', 'complement'):
+            sense, antisense = sifi.window_energies(right_end_type)
+            for window in range(len(sequence) - 20):
+                sirna_sequence = sifi._query_sequence[window:window+21]
+                if window < 2:
+                    expected = sifi.free_energy3(sirna_sequence)
+                else:
+                    sirna_sequence_n2 = sifi._query_sequence[window-2:window+19]
+                    expected = sifi.free_energy_dangling_ends(sirna_sequence, sirna_sequence_n2, right_end_type)
+                self.assertEqual((sense[window], antisense[window]), expected, (right_end_type, window))
+
+    def test_unknown_right_end_type(self):
+        sifi = pipeline.SifiPipeline()
+        sifi._query_sequence = random_sequence(self.rng, 50)
+        sifi._sirna_size = 21
+        with self.assertRaises(ValueError):
+            sifi.window_energies('blunt')
+
+
+class EnergyCacheTests(SimpleTestCase):
+    """Bounds and counters of the end energy cache."""
+
+    def test_bounded_lru(self):
+        cache = free_energy.EnergyCache(maxsize=3)
+        for key in 'abc':
+            cache.put(key, ord(key))
+        # a is used again, so b is the least recently used one
+        self.assertEqual(cache.get('a'), ord('a'))
+        cache.put('d', ord('d'))
+        self.assertEqual(len(cache), 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual([cache.get(key) for key in 'acd'], [ord('a'), ord('c'), ord('d')])
+
+    def test_counters(self):
+        cache = free_energy.EnergyCache(maxsize=10)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', -1.5)
+        cache.get('a')
+        cache.get('a')
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 1, 'size': 1, 'maxsize': 10})
+        cache.clear()
+        self.assertEqual(cache.stats(), {'hits': 0, 'misses': 0, 'size': 0, 'maxsize': 10})
+
+    def test_engine_uses_cache(self):
+        cache = free_energy.EnergyCache()
+        engine = free_energy.EnergyEngine(cache=cache)
+        first = engine.delta_g('ACG', c_seq='TTGC', shift=1)
+        self.assertEqual(cache.stats()['misses'], 1)
+        self.assertEqual(engine.delta_g('ACG', c_seq='TTGC', shift=1), first)
+        self.assertEqual(cache.stats()['hits'], 1)
+        # Another complement is another key
+        engine.delta_g('ACG')
+        self.assertEqual(cache.stats()['misses'], 2)
+        self.assertEqual(len(cache), 2)
+
+
+def baseline_pipeline(baseline, directory):
+    """A pipeline with the query, alignment, lunp data and SNPs of the baseline fixture."""
+    sequence, sirna_size = baseline['sequence'], baseline['sirna_size']
+    lunp_path = os.path.join(directory, 'query_lunp')
+    with open(lunp_path, 'w') as f:
+        f.write(baseline['lunp'])
+    snp_path = os.path.join(directory, 'snp.json')
+    with open(snp_path, 'w') as f:
+        json.dump(baseline['snps'], f)
+    sifi = pipeline.SifiPipeline()
+    sifi._bowtie_data = alignment.AlignmentHits.from_rows([
+        ['sirna{}'.format(i+1), '+', 'gene1', str(i), sequence[i:i+sirna_size], 'I'*sirna_size, '0']
+        for i in range(len(sequence) - sirna_size + 1)
+    ])
+    sifi._lunp_data = pipeline.read_lunp(lunp_path, sirna_size)
+    sifi.SNPs = snps.SnpStore(snps.convert_snp_json(snp_path, os.path.join(directory, 'snp.bin')))
+    sifi._query_sequence = sequence
+    sifi._query_name = 'query'
+    sifi._sirna_size = sirna_size
+    return sifi
+
+
+class CandidateTableTests(SimpleTestCase):
+    """process_data against the output of the per-siRNA implementation it replaced."""
+
+    def setUp(self):
+        with open(os.path.join(TESTDATA, 'baseline_process_data.json')) as f:
+            self.baseline = json.load(f)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def make_pipeline(self):
+        return baseline_pipeline(self.baseline, self.directory)
+
+    def test_process_data(self):
+        for case in self.baseline['cases']:
+            self.assertEqual(self.make_pipeline().process_data(**case['params']), case['table_data'], case['params'])
+
+    def test_refilter(self):
+        # One pipeline for every parameter set gives the results of fresh ones
+        sifi = self.make_pipeline()
+        for case in self.baseline['cases']:
+            self.assertEqual(sifi.process_data(**case['params']), case['table_data'], case['params'])
+
+    def test_table_reused(self):
+        sifi = self.make_pipeline()
+        params = dict(self.baseline['cases'][0]['params'])
+        with mock.patch.object(sifi, 'candidate_table', wraps=sifi.candidate_table) as candidate_table:
+            first = sifi.process_data(**params)
+            # Only thresholds and checks change, the table is not built again
+            params.update(min_gc_range=20, max_gc_range=80, end_check=False, target='gene2')
+            sifi.process_data(**params)
+            self.assertEqual(candidate_table.call_count, 1)
+            params.update(accessibility_window=10)
+            sifi.process_data(**params)
+            self.assertEqual(candidate_table.call_count, 2)
+            params.update(right_end_type='complement')
+            sifi.process_data(**params)
+            self.assertEqual(candidate_table.call_count, 3)
+            # Filtering does not change the cached table
+            self.assertEqual(sifi.process_data(**self.baseline['cases'][0]['params']), first)
+
+
+class MotifIndexTests(SimpleTestCase):
+    """MotifIndex against a substring scan over the motifs and their reverse complements."""
+
+    def setUp(self):
+        self.rng = random.Random(2)
+        self.index = motifs.DAMAGING_INDEX
+        self.patterns = set(motifs.DAMAGING_MOTIFS) | {reverse_complement(motif) for motif in motifs.DAMAGING_MOTIFS}
+
+    def sequences(self):
+        for _ in range(100):
+            sequence = random_sequence(self.rng, self.rng.randint(0, 120))
+            if sequence and self.rng.random() < 0.5:
+                # Plant a motif, the random sequences rarely contain the long ones
+                position = self.rng.randint(0, len(sequence))
+                sequence = sequence[:position] + self.rng.choice(sorted(self.patterns)) + sequence[position:]
+            yield sequence
+
+    def test_search(self):
+        for sequence in self.sequences():
+            expected = any(pattern in sequence for pattern in self.patterns)
+            self.assertEqual(self.index.search(sequence), expected, sequence)
+
+    def test_damaged_windows(self):
+        size = 21
+        for sequence in self.sequences():
+            expected = [
+                any(pattern in sequence[i:i+size] for pattern in self.patterns)
+                for i in range(max(len(sequence) - size + 1, 0))
+            ]
+            self.assertEqual(self.index.damaged_windows(sequence, size).tolist(), expected, sequence)
+
+
+class SnpStoreTests(SimpleTestCase):
+    """SNP counts of the store against a scan of the snp.json lookup."""
+
+    def setUp(self):
+        self.rng = random.Random(4)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.snps = {
+            'gene{}'.format(i): [self.rng.randrange(500) for _ in range(self.rng.randint(0, 40))]
+            for i in range(10)
+        }
+        self.snps['empty'] = []
+        json_path = os.path.join(self.directory, 'snp.json')
+        with open(json_path, 'w') as f:
+            json.dump(self.snps, f)
+        self.store = snps.SnpStore(snps.convert_snp_json(json_path, os.path.join(self.directory, 'snp.bin')))
+
+    def expected_count(self, transcript, start, size):
+        # As the former is_snp, which scanned the JSON positions
+        return sum(1 for snp in self.snps.get(transcript, []) if start <= int(snp) <= start + size - 1)
+
+    def test_window_counts(self):
+        starts = np.arange(0, 520)
+        for transcript in list(self.snps) + ['unknown']:
+            for size in (1, 21):
+                self.assertEqual(
+                    self.store.window_counts(transcript, starts, size).tolist(),
+                    [self.expected_count(transcript, start, size) for start in starts],
+                    (transcript, size)
+                )
+
+    def test_count(self):
+        for _ in range(200):
+            transcript = self.rng.choice(sorted(self.snps))
+            start = self.rng.randrange(500)
+            self.assertEqual(self.store.count(transcript, start, 21), self.expected_count(transcript, start, 21))
+
+    def test_transcripts(self):
+        self.assertEqual(set(self.store.keys()), set(self.snps))
+        self.assertIn('gene0', self.store)
+        self.assertNotIn('unknown', self.store)
+        self.assertEqual(self.store.positions('gene1').tolist(), sorted(self.snps['gene1']))
+
+    def test_load_snp_index(self):
+        store_path = os.path.join(self.directory, 'snp.bin')
+        self.assertIs(snps.load_snp_index(store_path), snps.load_snp_index(store_path))
+        with self.assertRaises(ValueError):
+            snps.load_snp_index(os.path.join(self.directory, 'missing.bin'))
+
+    def test_convert_snps_command(self):
+        json_path = os.path.join(self.directory, 'snp.json')
+        store_path = os.path.join(self.directory, 'snp.bin')
+        old = snps.load_snp_index(store_path)
+        with open(json_path, 'w') as f:
+            json.dump({'gene0': [3, 1]}, f)
+        call_command('convert_snps', json_path, stdout=io.StringIO())
+        # The conversion replaces the store, the next request maps the new one
+        new = snps.load_snp_index(store_path)
+        self.assertIsNot(new, old)
+        self.assertEqual(list(new.keys()), ['gene0'])
+        self.assertEqual(new.positions('gene0').tolist(), [1, 3])
+        # No temporary file is left behind
+        self.assertEqual(sorted(os.listdir(self.directory)), ['snp.bin', 'snp.json'])
+        with self.assertRaises(CommandError):
+            call_command('convert_snps', os.path.join(self.directory, 'missing.json'), stdout=io.StringIO())
+
+
+class KmerIndexTests(SimpleTestCase):
+    """Exact hits of the k-mer index against a brute force scan of the references."""
+
+    def setUp(self):
+        self.rng = random.Random(3)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        shared = random_sequence(self.rng, 60)
+        self.references = {}
+        for i in range(6):
+            # Shared stretches (also reverse complemented) give several hits per k-mer
+            sequence = random_sequence(self.rng, self.rng.randint(30, 300), 'ACGTN' if i == 3 else 'ACGT')
+            sequence += shared if i % 2 else reverse_complement(shared)
+            self.references['ref%d' % i] = sequence
+        self.query = random_sequence(self.rng, 40) + shared + random_sequence(self.rng, 40)
+        self.fasta_file = os.path.join(self.directory, 'db.fa')
+        with open(self.fasta_file, 'w') as f:
+            for name, sequence in self.references.items():
+                f.write('>%s\n%s\n' % (name, sequence))
+
+    def brute_force(self, k):
+        hits = set()
+        for i in range(len(self.query) - k + 1):
+            kmer = self.query[i:i+k]
+            reverse_kmer = reverse_complement(kmer)
+            for name, sequence in self.references.items():
+                for offset in range(len(sequence) - k + 1):
+                    window = sequence[offset:offset+k]
+                    if window == kmer:
+                        hits.add((i + 1, False, name, offset, window))
+                    if window == reverse_kmer:
+                        hits.add((i + 1, True, name, offset, window))
+        return hits
+
+    def test_align(self):
+        for k, chunk_size in ((21, 50), (21, 1 << 20), (15, 7)):
+            base = os.path.join(self.directory, 'db%d_%d' % (k, chunk_size))
+            kmer_index.build_kmer_index(self.fasta_file, base, k=k, chunk_size=chunk_size)
+            hits = kmer_index.KmerIndex(base, k=k).align(self.query)
+            found = {(hit.query, hit.reverse, hit.target, hit.offset, hit.sequence) for hit in hits}
+            self.assertEqual(len(found), len(hits))
+            self.assertEqual(found, self.brute_force(k))
+
+    def test_k_too_long(self):
+        with self.assertRaises(ValueError):
+            kmer_index.build_kmer_index(self.fasta_file, os.path.join(self.directory, 'long'), k=kmer_index.MAX_K + 1)
+
+    def test_database_without_index(self):
+        # bowtie-build only leaves its last index file behind
+        def bowtie_build(args, cwd):
+            open(os.path.join(cwd, args[2] + '.rev.1.ebwt'), 'w').close()
+            return mock.Mock()
+
+        base = os.path.join(self.directory, 'db')
+        kmer_index.build_kmer_index(self.fasta_file, base, k=21)
+        with mock.patch.object(database_helpers.subprocess, 'Popen', side_effect=bowtie_build), \
+                mock.patch.object(kmer_index, 'build_kmer_index', side_effect=MemoryError), \
+                self.assertLogs(level='ERROR'):
+            message, created, _, _ = database_helpers.create_bowtie_database('db', self.fasta_file, self.directory)
+        # The database is created, the index of the former one is removed and bowtie aligns instead
+        self.assertTrue(created)
+        self.assertIsNone(kmer_index.load_kmer_index(base, 21))
+        self.assertEqual([path for path in os.listdir(self.directory) if '.kmer' in path], [])
+
+
+class FanOutTests(SimpleTestCase):
+    """Hits of the distinct candidates fanned out against aligning every candidate."""
+
+    def setUp(self):
+        self.rng = random.Random(5)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        repeat = random_sequence(self.rng, 30)
+        references = [random_sequence(self.rng, 200) + repeat + reverse_complement(repeat) for _ in range(3)]
+        with open(os.path.join(self.directory, 'db.fa'), 'w') as f:
+            for i, sequence in enumerate(references):
+                f.write('>ref%d\n%s\n' % (i, sequence))
+        self.base = os.path.join(self.directory, 'db')
+        kmer_index.build_kmer_index(os.path.join(self.directory, 'db.fa'), self.base, k=21)
+        # Repeats (also in lower case) give identical candidates
+        self.query = repeat + random_sequence(self.rng, 25) + repeat.lower() + references[1][100:160] + repeat
+
+    def test_unique_candidates(self):
+        representatives, representative_of = alignment.unique_candidates(self.query, 21)
+        windows = [self.query[i:i+21].upper() for i in range(len(self.query) - 20)]
+        self.assertEqual(len(representative_of), len(windows))
+        for i, window in enumerate(windows):
+            self.assertEqual(representative_of[i], windows.index(window) + 1)
+        self.assertEqual(representatives.tolist(), sorted(set(representative_of.tolist())))
+
+    def test_fan_out(self):
+        index = kmer_index.KmerIndex(self.base, k=21)
+        representatives, representative_of = alignment.unique_candidates(self.query, 21)
+        fanned = index.align(self.query, candidates=representatives).fan_out(representative_of)
+        self.assertEqual(fanned.rows(), index.align(self.query).rows())
+        sifi = pipeline.SifiPipeline()
+        aligned = sifi.align(query_sequence=self.query, bowtie_db='db', bowtie_location=self.directory,
+                             sirna_size=21, mismatches=0)
+        self.assertEqual(aligned.rows(), fanned.rows())
+
+    def test_no_hits(self):
+        hits = alignment.AlignmentHits().fan_out([1, 1, 3])
+        self.assertEqual(len(hits), 0)
+
+
+class StitchedFoldingTests(SimpleTestCase):
+    """Chunked folding with canned lunp files, RNAplfold is not needed."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.running = self.most_running = 0
+        self.lock = threading.Lock()
+
+    def canned_fold(self, sequence, sirna_size):
+        # A lunp file whose probabilities only depend on the bases ending at
+        # their position, like RNAplfold's on the windows around it
+        with self.lock:
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        lines = ['# unpaired probabilities', '#i$\tl=1']
+        for position in range(1, len(sequence) + 1):
+            values = [
+                '%.4f' % (zlib.crc32(sequence[position-j:position].encode()) % 10000 / 10000) if j <= position else 'NA'
+                for j in range(1, sirna_size + 1)
+            ]
+            lines.append('%d\t%s' % (position, '\t'.join(values)))
+        fd, path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        time.sleep(0.01)
+        with self.lock:
+            self.running -= 1
+        return pipeline.read_lunp(path, sirna_size)
+
+    def test_fold(self):
+        sequence = random_sequence(random.Random(6), 1500)
+        sifi = pipeline.SifiPipeline()
+        sifi.PLFOLD_CHUNK_SIZE = 200
+        sifi.fold_workers = 2
+        sifi.fold_sequence = self.canned_fold
+        whole = self.canned_fold(sequence, 21)
+        chunked = sifi.fold(sequence, 21)
+        np.testing.assert_array_equal(chunked, whole)
+        self.assertEqual(chunked[0, 0], 21)
+        self.assertEqual(chunked[-1, 0], 1500)
+        self.assertLessEqual(self.most_running, 2)
+
+    def test_stitch_lunp(self):
+        sifi = pipeline.SifiPipeline()
+        sifi.PLFOLD_CHUNK_SIZE = 100
+        for length in (21, 100, 101, 130, 301):
+            sequence = random_sequence(random.Random(length), length)
+            cores, chunks = sifi.fold_chunks(length, 21)
+            folded = [self.canned_fold(sequence[start:end], 21) for start, end in chunks]
+            np.testing.assert_array_equal(
+                pipeline.stitch_lunp(cores, chunks, folded, 21), self.canned_fold(sequence, 21), str(length))
+
+    def test_batch_fold_workers(self):
+        settings = []
+
+        def submit(function, record_id, query_sequence, setting):
+            settings.append(setting)
+            future = concurrent.futures.Future()
+            future.set_result((record_id, {}))
+            return future
+
+        with mock.patch.object(pipeline.concurrent.futures, 'ProcessPoolExecutor') as executor:
+            executor.return_value.__enter__.return_value.submit.side_effect = submit
+            fasta = os.path.join(self.directory, 'batch.fa')
+            with open(fasta, 'w') as f:
+                f.write('>a\nACGT\n>b\nACGT\n')
+            with mock.patch.object(pipeline.os, 'cpu_count', return_value=8):
+                list(pipeline.SifiPipeline().iter_batch(query_sequences=fasta, max_workers=4))
+        # Four records at a time on eight CPUs fold on two each
+        self.assertEqual([setting['fold_workers'] for setting in settings], [2, 2])
+
+
+@unittest.skipUnless(shutil.which('RNAplfold'), 'RNAplfold is not installed')
+class ChunkedFoldingTests(SimpleTestCase):
+    """Long sequences folded in chunks against RNAplfold on the whole sequence."""
+
+    def test_fold(self):
+        rng = random.Random(4)
+        sequence = random_sequence(rng, 1500)
+        sifi = pipeline.SifiPipeline()
+        sifi.PLFOLD_CHUNK_SIZE = 400
+        whole = sifi.fold_sequence(sequence, 21)
+        chunked = sifi.fold(sequence, 21)
+        self.assertEqual(chunked.shape, whole.shape)
+        # Every position, including the ones next to the chunk borders
+        np.testing.assert_array_equal(chunked, whole)
+
+
+class DiskCacheTests(SimpleTestCase):
+    """Keys, eviction and the RNAplfold results of the on-disk cache."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cache = cache.DiskCache(self.directory)
+
+    def test_key(self):
+        self.assertEqual(cache.DiskCache.key('lunp', 'ACGU', 80, 40), cache.DiskCache.key('lunp', 'ACGU', 80, 40))
+        keys = {
+            cache.DiskCache.key(*parts)
+            for parts in (('lunp', 'ACGU', 80, 40), ('lunp', 'ACGU', 80, 41), ('lunp', 'ACGUA', 80, 40), ('bowtie', 'ACGU', 80, 40))
+        }
+        self.assertEqual(len(keys), 4)
+
+    def test_put_get(self):
+        key = self.cache.key('entry')
+        self.assertIsNone(self.cache.get(key))
+        arrays = {'lunp': np.arange(12, dtype=np.float32).reshape(3, 4), 'names': np.array(['a', 'bc'])}
+        self.cache.put(key, arrays)
+        cached = self.cache.get(key)
+        self.assertEqual(sorted(cached), ['lunp', 'names'])
+        for name in arrays:
+            np.testing.assert_array_equal(cached[name], arrays[name])
+            self.assertEqual(cached[name].dtype, arrays[name].dtype)
+        # Only the entry is left, no temporary files
+        self.assertEqual(os.listdir(os.path.dirname(self.cache.path(key))), [key + '.npz'])
+
+    def test_broken_entry(self):
+        key = self.cache.key('broken')
+        os.makedirs(os.path.dirname(self.cache.path(key)))
+        with open(self.cache.path(key), 'wb') as f:
+            f.write(b'not an npz file')
+        self.assertIsNone(self.cache.get(key))
+
+    def test_evict_least_recently_used(self):
+        keys = [self.cache.key('entry', i) for i in range(4)]
+        for i, key in enumerate(keys):
+            self.cache.put(key, {'data': np.zeros(1000)})
+            os.utime(self.cache.path(key), (1000 + i, 1000 + i))
+        # Reading the oldest one makes it the most recently used
+        self.cache.get(keys[0])
+        self.cache.max_bytes = 3 * os.path.getsize(self.cache.path(keys[0]))
+        self.cache.evict()
+        self.assertEqual([self.cache.get(key) is not None for key in keys], [True, False, True, True])
+        self.cache.clear()
+        self.assertEqual([self.cache.get(key) for key in keys], [None] * 4)
+
+    def test_lunp(self):
+        sifi = pipeline.SifiPipeline(cache=self.cache)
+        lunp = np.arange(44, dtype=np.float32).reshape(2, 22)
+        with mock.patch.object(sifi, 'fold', return_value=lunp) as fold:
+            first = sifi.run_rnaplfold(query_sequence='ACGU' * 10, sirna_size=21)
+            second = sifi.run_rnaplfold(query_sequence='ACGU' * 10, sirna_size=21)
+            self.assertEqual(fold.call_count, 1)
+            np.testing.assert_array_equal(first, lunp)
+            np.testing.assert_array_equal(second, lunp)
+            # Another sequence, siRNA size or folding parameter is folded again
+            sifi.run_rnaplfold(query_sequence='ACGU' * 11, sirna_size=21)
+            sifi.run_rnaplfold(query_sequence='ACGU' * 10, sirna_size=19)
+            sifi.TEMPERATURE = 37
+            sifi.run_rnaplfold(query_sequence='ACGU' * 10, sirna_size=21)
+            self.assertEqual(fold.call_count, 4)
+        # Pipelines of other processes (the cache is pickled) share the entries
+        other = pickle.loads(pickle.dumps(pipeline.SifiPipeline(cache=self.cache)))
+        with mock.patch.object(other, 'fold') as fold:
+            np.testing.assert_array_equal(other.run_rnaplfold(query_sequence='ACGU' * 10, sirna_size=21), lunp)
+            fold.assert_not_called()
+
+
+class AlignmentCacheTests(SimpleTestCase):
+    """Cached bowtie hits and their invalidation when the database changes."""
+
+    # Reports every candidate once on gene1 and counts its runs
+    BOWTIE = '''#!{python}
+import sys
+with open({runs!r}, 'a') as f:
+    f.write('run\\n')
+name = None
+for line in sys.stdin:
+    line = line.strip()
+    if line.startswith('>'):
+        name = line[1:]
+    elif line:
+        number = int(name[len('sirna'):])
+        sys.stdout.write('%s\\t+\\tgene1\\t%d\\t%s\\t%s\\t0\\n' % (name, number - 1, line, 'I' * len(line)))
+'''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.runs = os.path.join(self.directory, 'runs')
+        bin_directory = os.path.join(self.directory, 'bin')
+        os.makedirs(bin_directory)
+        with open(os.path.join(bin_directory, 'bowtie'), 'w') as f:
+            f.write(self.BOWTIE.format(python=sys.executable, runs=self.runs))
+        os.chmod(os.path.join(bin_directory, 'bowtie'), 0o755)
+        patcher = mock.patch.dict(os.environ, {'PATH': bin_directory + os.pathsep + os.environ.get('PATH', '')})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.bowtie_location = os.path.join(self.directory, 'Bowtie')
+        os.makedirs(self.bowtie_location)
+        self.write_database(b'database')
+        self.sifi = pipeline.SifiPipeline(cache=cache.DiskCache(os.path.join(self.directory, 'cache')))
+        self.query = random_sequence(random.Random(7), 60)
+
+    def write_database(self, content):
+        for ending in indexes.BOWTIE_ENDINGS:
+            with open(os.path.join(self.bowtie_location, 'db' + ending), 'wb') as f:
+                f.write(content)
+
+    def bowtie_runs(self):
+        with open(self.runs) as f:
+            return len(f.readlines())
+
+    def run_bowtie(self, mismatches=0, candidates=None):
+        return self.sifi.run_bowtie(query_sequence=self.query, bowtie_db='db', bowtie_location=self.bowtie_location,
+                                    sirna_size=21, mismatches=mismatches, candidates=candidates).rows()
+
+    def test_cached(self):
+        first = self.run_bowtie()
+        self.assertEqual(len(first), 40)
+        self.assertEqual(self.run_bowtie(), first)
+        self.assertEqual(self.bowtie_runs(), 1)
+        # Other mismatches, candidates or queries are aligned again
+        self.run_bowtie(mismatches=1)
+        self.assertEqual(len(self.run_bowtie(candidates=[1, 5])), 2)
+        self.query = self.query[1:]
+        self.run_bowtie()
+        self.assertEqual(self.bowtie_runs(), 4)
+
+    def test_rebuilt_database(self):
+        self.run_bowtie()
+        # A rebuilt database has other index files
+        self.write_database(b'rebuilt database')
+        self.run_bowtie()
+        self.assertEqual(self.bowtie_runs(), 2)
+        self.run_bowtie()
+        self.assertEqual(self.bowtie_runs(), 2)
+        # The same size, but written later
+        stat = os.stat(os.path.join(self.bowtie_location, 'db.1.ebwt'))
+        os.utime(os.path.join(self.bowtie_location, 'db.1.ebwt'), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.run_bowtie()
+        self.assertEqual(self.bowtie_runs(), 3)
+
+
+class JobQueueTests(TransactionTestCase):
+    """Jobs run by the worker threads and their state in the database."""
+
+    def setUp(self):
+        self.queue = jobs.JobQueue(max_workers=1, max_queued=1)
+        self.addCleanup(self.queue._executor.shutdown)
+
+    def wait(self, job_id, states=('done', 'failed')):
+        for _ in range(500):
+            job = self.queue.get(job_id)
+            if job['state'] in states:
+                return job
+            time.sleep(0.01)
+        self.fail('job {} did not reach {}'.format(job_id, states))
+
+    def test_done(self):
+        def function(progress, a, b):
+            progress('adding', 1, 2)
+            return {'sum': a + b}
+
+        job = self.wait(self.queue.submit(function, 1, 2))
+        self.assertEqual((job['state'], job['stage'], job['result']), ('done', 'done', {'sum': 3}))
+        self.assertEqual((job['done'], job['total']), (1, 2))
+        self.assertIsNone(self.queue.get('unknown'))
+
+    def test_failed(self):
+        def function(progress):
+            raise ValueError('no sequence')
+
+        job = self.wait(self.queue.submit(function))
+        self.assertEqual((job['state'], job['error'], job['result']), ('failed', 'no sequence', None))
+        # A result which is not JSON fails the job as well
+        job = self.wait(self.queue.submit(lambda progress: {'data': object()}))
+        self.assertEqual(job['state'], 'failed')
+
+    def test_queue_full(self):
+        started, release = threading.Event(), threading.Event()
+
+        def function(progress):
+            started.set()
+            release.wait(5)
+
+        running = self.queue.submit(function)
+        started.wait(5)
+        queued = self.queue.submit(function)
+        with self.assertRaises(jobs.QueueFull):
+            self.queue.submit(function)
+        self.assertEqual(self.queue.get(queued)['state'], 'queued')
+        release.set()
+        self.assertEqual(self.wait(running)['state'], 'done')
+        self.assertEqual(self.wait(queued)['state'], 'done')
+
+    def test_restart(self):
+        Job.objects.create(job_id='running', state='running')
+        Job.objects.create(job_id='finished', state='done', result=[1])
+        jobs.JobQueue()
+        self.assertEqual(self.queue.get('running')['state'], 'failed')
+        self.assertEqual(self.queue.get('finished')['result'], [1])
+
+    def test_old_jobs_deleted(self):
+        Job.objects.create(job_id='old', state='done')
+        Job.objects.create(job_id='new', state='done')
+        Job.objects.filter(job_id='old').update(updated=timezone.now() - datetime.timedelta(days=8))
+        self.wait(self.queue.submit(lambda progress: None))
+        self.assertIsNone(self.queue.get('old'))
+        self.assertIsNotNone(self.queue.get('new'))
+
+
+class SizedPipeline(object):
+    """Stand-in for SifiPipeline in the registry, with a given memory size."""
+
+    def __init__(self, size):
+        self.size = size
+
+    def memory_size(self):
+        return self.size
+
+
+class PipelineRegistryTests(SimpleTestCase):
+    """Eviction, spilling and reloading of the pipelines of the registry."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def spilled(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith('.pickle'))
+
+    def test_spill_and_reload(self):
+        pipelines = registry.PipelineRegistry(max_bytes=250, spill_directory=self.directory)
+        keys = [pipelines.add(SizedPipeline(100 + i)) for i in range(5)]
+        # Two fit into memory, the others are pickled
+        self.assertEqual(len(pipelines), 5)
+        self.assertEqual(len(self.spilled()), 3)
+        self.assertEqual([pipelines.get(key).size for key in keys], [100, 101, 102, 103, 104])
+        # Loading one spills the least recently used ones, never the loaded one
+        self.assertEqual(len(self.spilled()), 3)
+        self.assertEqual(pipelines.get(keys[0]).size, 100)
+        self.assertIn(keys[0], pipelines._pipelines)
+
+    def test_without_spill_directory(self):
+        pipelines = registry.PipelineRegistry(max_bytes=250)
+        keys = [pipelines.add(SizedPipeline(100)) for _ in range(3)]
+        self.assertIsNone(pipelines.get(keys[0]))
+        self.assertEqual(len(pipelines), 2)
+
+    def test_limits(self):
+        pipelines = registry.PipelineRegistry(max_bytes=0, spill_directory=self.directory, max_spilled=2)
+        keys = [pipelines.add(SizedPipeline(100)) for _ in range(5)]
+        # The most recently used one stays in memory, two are spilled and the oldest are dropped
+        self.assertEqual(len(self.spilled()), 2)
+        self.assertEqual([key in pipelines for key in keys], [False, False, True, True, True])
+        self.assertIsNone(pipelines.get(keys[0]))
+        pipelines.remove(keys[2])
+        self.assertNotIn(keys[2], pipelines)
+        self.assertEqual(len(self.spilled()), 1)
+        self.assertIsNone(pipelines.get(None))
+
+    def test_expiry(self):
+        pipelines = registry.PipelineRegistry(max_bytes=0, spill_directory=self.directory, max_age=60)
+        keys = [pipelines.add(SizedPipeline(100)) for _ in range(3)]
+        with mock.patch.object(registry.time, 'time', return_value=time.time() + 120):
+            self.assertIsNone(pipelines.get(keys[1]))
+            self.assertEqual(len(pipelines), 0)
+        self.assertEqual(self.spilled(), [])
+
+    def test_stale_files_removed(self):
+        with open(os.path.join(self.directory, 'old.pickle'), 'wb') as f:
+            f.write(b'from an earlier server')
+        registry.PipelineRegistry(spill_directory=self.directory)
+        self.assertEqual(self.spilled(), [])
+
+    def test_sifi_pipeline(self):
+        with open(os.path.join(TESTDATA, 'baseline_process_data.json')) as f:
+            baseline = json.load(f)
+        case = baseline['cases'][0]
+        pipelines = registry.PipelineRegistry(max_bytes=0, spill_directory=self.directory)
+        sifi = baseline_pipeline(baseline, self.directory)
+        sifi.process_data(**case['params'])
+        key = pipelines.add(sifi)
+        pipelines.add(SizedPipeline(100))
+        self.assertEqual(len(self.spilled()), 1)
+        # The reloaded pipeline has its query, alignment, lunp data and SNPs
+        loaded = pipelines.get(key)
+        self.assertIsNot(loaded, sifi)
+        self.assertEqual(loaded.process_data(**case['params']), case['table_data'])
+
+
+class StreamedResponseTests(SimpleTestCase):
+    """Framing of the newline delimited JSON responses."""
+
+    def setUp(self):
+        rng = random.Random(8)
+        self.align_data = alignment.AlignmentHits.from_rows([
+            ['sirna{}'.format(i), '+' if i % 3 else '-', 'gene{}'.format(i % 4), str(i), random_sequence(rng, 21), 'I'*21, '0']
+            for i in range(1, 11)
+        ])
+        self.luna_data = np.array([[i] + [rng.random() for _ in range(21)] for i in range(21, 28)], dtype=np.float32)
+
+    def lines(self, response):
+        content = b''.join(response.streaming_content).decode()
+        self.assertTrue(content.endswith('\n'))
+        lines = content.split('\n')[:-1]
+        return [json.loads(line) for line in lines]
+
+    def test_ndjson_response(self):
+        response = views.ndjson_response(iter([{'a': 1}, {'b': 'line\nbreak'}, {}]))
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(self.lines(response), [{'a': 1}, {'b': 'line\nbreak'}, {}])
+
+    def test_pipeline_lines(self):
+        with mock.patch.object(views, 'STREAM_CHUNK_SIZE', 3):
+            lines = self.lines(views.ndjson_response(views.pipeline_lines('session', self.align_data, self.luna_data)))
+        self.assertEqual(lines[0], {'session_id': 'session'})
+        align_lines = [line['align_data'] for line in lines if 'align_data' in line]
+        luna_lines = [line['luna_data'] for line in lines if 'luna_data' in line]
+        self.assertEqual([len(chunk) for chunk in align_lines], [3, 3, 3, 1])
+        self.assertEqual([len(chunk) for chunk in luna_lines], [3, 3, 1])
+        # The chunks joined are the data of the response which is not streamed
+        self.assertEqual(sum(align_lines, []), self.align_data.rows())
+        self.assertEqual(sum(luna_lines, []), views.luna_rows(self.luna_data))
+        self.assertEqual(len(lines), 1 + len(align_lines) + len(luna_lines))
+
+
+class AccessibilityTests(SimpleTestCase):
+    """The float32 accessibility payload of a session."""
+
+    def setUp(self):
+        self.sifi = pipeline.SifiPipeline()
+        self.sifi._lunp_data = np.array(
+            [[position] + [random.Random(position).random() for _ in range(21)] for position in range(21, 61)],
+            dtype=np.float32
+        )
+        self.sifi._sirna_size = 21
+        pipelines = registry.PipelineRegistry()
+        self.session_id = pipelines.add(self.sifi)
+        patcher = mock.patch.object(views, 'get_pipelines', return_value=pipelines)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, **order):
+        request = RequestFactory().post('/analysis/accessibility', json.dumps(dict(order, session_id=self.session_id)),
+                                        content_type='application/json')
+        return views.accessibility(request)
+
+    def test_profile(self):
+        lunp_data, sirna_size = self.sifi.accessibility_profile()
+        self.assertEqual(lunp_data.dtype, np.dtype('<f4'))
+        np.testing.assert_array_equal(lunp_data, self.sifi._lunp_data)
+        self.assertEqual(sirna_size, 21)
+
+    def test_base64(self):
+        payload = json.loads(self.post(window=8).content)
+        self.assertEqual((payload['first_position'], payload['window'], payload['dtype']), (21, 8, 'float32'))
+        values = np.frombuffer(base64.b64decode(payload['data']), dtype='<f4').reshape(payload['shape'])
+        # The exact float32 values, not rounded copies
+        np.testing.assert_array_equal(values, self.sifi._lunp_data[:, 8])
+
+    def test_binary_full(self):
+        response = self.post(full=True, format='binary')
+        self.assertEqual(response['Content-Type'], 'application/octet-stream')
+        self.assertEqual((response['X-First-Position'], response['X-Window'], response['X-Shape']), ('21', 'full', '40,22'))
+        values = np.frombuffer(response.content, dtype='<f4').reshape(40, 22)
+        np.testing.assert_array_equal(values, self.sifi._lunp_data)
+
+    def test_bad_window(self):
+        self.assertEqual(self.post(window=22).status_code, 400)
+        self.assertEqual(self.post(window=0).status_code, 400)
+
+
+class CandidatePageTests(SimpleTestCase):
+    """Paging and sorting of the selected candidates through process_data."""
+
+    def setUp(self):
+        with open(os.path.join(TESTDATA, 'baseline_process_data.json')) as f:
+            baseline = json.load(f)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.design = baseline['cases'][0]['params']
+        self.table_data = baseline['cases'][0]['table_data']
+        self.sifi = baseline_pipeline(baseline, self.directory)
+        pipelines = registry.PipelineRegistry()
+        self.session_id = pipelines.add(self.sifi)
+        patcher = mock.patch.object(views, 'get_pipelines', return_value=pipelines)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, **order):
+        request = RequestFactory().post('/analysis/process_data', json.dumps(dict(order, session_id=self.session_id)),
+                                        content_type='application/json')
+        return views.process_data(request)
+
+    def page(self, **order):
+        response = self.post(**order)
+        self.assertEqual(response.status_code, 200, response.content)
+        return json.loads(response.content)
+
+    def test_pages(self):
+        first = self.page(page_size=7, **self.design)
+        self.assertEqual((first['total'], first['page'], first['page_size']), (len(self.table_data), 1, 7))
+        records = first['table_data']
+        for page in range(2, len(self.table_data) // 7 + 3):
+            records += self.page(page=page, page_size=7)['table_data']
+        self.assertEqual(records, self.table_data)
+        self.assertEqual(self.page(page_size=-1)['table_data'], self.table_data)
+
+    def test_sorted(self):
+        for sort_by, key in (('gc', lambda record: record['gc_content']),
+                             ('delta_MFE', lambda record: record['delta_MFE_enegery']),
+                             ('accessibility_value', lambda record: record['accessibility_value'])):
+            for descending in (False, True):
+                page = self.page(page_size=-1, sort_by=sort_by, descending=descending, **self.design)
+                # Stable, ties stay in position order
+                expected = sorted(self.table_data, key=lambda record: -key(record) if descending else key(record))
+                self.assertEqual(page['table_data'], expected, (sort_by, descending))
+
+    def test_columns(self):
+        page = self.page(page_size=3, columns=['sirna_position', 'gc_content'], **self.design)
+        self.assertEqual(page['table_data'], [
+            {'sirna_position': record['sirna_position'], 'gc_content': record['gc_content']}
+            for record in self.table_data[:3]
+        ])
+
+    def test_bad_input(self):
+        self.page(**self.design)
+        for order in ({'page': 'x'}, {'page_size': 'ten'}, {'page_size': None}, {'page': 0},
+                      {'sort_by': 'unknown'}, {'columns': ['unknown']}):
+            self.assertEqual(self.post(**order).status_code, 400, order)
+        # A page size below 1 (except -1 for all) gives one candidate per page
+        for page_size in (0, -5):
+            page = self.page(page_size=page_size)
+            self.assertEqual((page['page_size'], len(page['table_data'])), (1, 1))
+        self.assertEqual(self.page(page=1000)['table_data'], [])
+
+
+class TableDataTests(SimpleTestCase):
+    """get_table_data against the per hit counting it replaced."""
+
+    def test_order(self):
+        rng = random.Random(5)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'hits.json')
+        for _ in range(20):
+            names = ['gene%d' % i for i in range(rng.randint(1, 8))]
+            records = []
+            for _ in range(rng.randint(0, 200)):
+                position = rng.randint(1, 200)
+                records.append({
+                    'hit_name': rng.choice(names),
+                    'sirna_name': 'sirna%d' % position,
+                    'sirna_position': position,
+                    'is_efficient': rng.random() < 0.3,
+                    'is_off_target': rng.random() < 0.4,
+                })
+            with open(path, 'w') as f:
+                json.dump(records, f)
+            # Most hits first, ties in order of appearance (Counter.most_common)
+            efficient = Counter(record['hit_name'] for record in records if record['is_efficient'])
+            expected = [
+                [name, count, efficient[name]]
+                for name, count in Counter(record['hit_name'] for record in records).most_common()
+            ]
+            self.assertEqual(general_helpers.get_table_data(path), expected)
+
+    def test_target_data(self):
+        rng = random.Random(6)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'hits.json')
+        size = 21
+        for _ in range(20):
+            names = ['gene%d' % i for i in range(rng.randint(1, 5))]
+            records = []
+            for _ in range(rng.randint(0, 100)):
+                position = rng.randint(1, 300)
+                records.append({
+                    'hit_name': rng.choice(names),
+                    'sirna_name': 'sirna%d' % position,
+                    'sirna_position': position,
+                    'is_efficient': rng.random() < 0.3,
+                    'is_off_target': rng.random() < 0.4,
+                })
+            with open(path, 'w') as f:
+                json.dump(records, f)
+            off_target, main_target, efficient, histogram = general_helpers.get_target_data(path, size)
+
+            def covered(selected):
+                positions = {}
+                for record in selected:
+                    positions.setdefault(record['hit_name'], set()).update(
+                        range(record['sirna_position'], record['sirna_position'] + size))
+                return positions
+
+            off_target_records = [record for record in records if record['is_off_target']]
+            on_target_records = [record for record in records if not record['is_off_target']]
+            excluded = set().union(*covered(off_target_records).values())
+            self.assertEqual(off_target, covered(off_target_records))
+            self.assertEqual(main_target, {name: positions - excluded for name, positions in covered(on_target_records).items()})
+            self.assertEqual(efficient, covered(record for record in records if record['is_efficient']))
+            # Every on-target siRNA once, however many hits it has
+            sirnas = {(record['sirna_name'], record['sirna_position']) for record in on_target_records}
+            self.assertEqual(
+                histogram,
+                sorted(position for _, start in sirnas for position in range(start, start + size))
+            )
@@ -5,7 +5,12 @@ urlpatterns = [
     path('createDatabase', views.create_database),
     path('getAllDatabasesInfo', views.get_all_databases_info),
     path('run_pipeline', views.run_pipeline),
+    path('jobs', views.submit_job),
+    path('jobs/<str:job_id>', views.job_status),
     path('process_data', views.process_data),
+    path('accessibility', views.accessibility),
+    path('off_target_report', views.off_target_report),
+    path('close_session', views.close_session),
     path('removeDatabase', views.removeDatabase),
     path('shareDatabase', views.shareDatabase),
     path('exportTable', views.exportTable)
@@ -1,18 +1,94 @@
 from django.shortcuts import render
-from django.http import JsonResponse, HttpRequest, HttpResponse
+from django.http import JsonResponse, HttpRequest, HttpResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 
 import json
 import shutil
+import base64
+import threading
+from itertools import islice
 from analysis import database_helpers
 from analysis import  pipeline
 from analysis import general_helpers
+from analysis import cache
+from analysis import registry
+from analysis import jobs
 
 from django.conf import settings
 from os import path
 
 rnaplfold_location = path.join(settings.BASE_DIR, 'RNAplfold')
 bowtie_location    = path.join(settings.BASE_DIR, 'Bowtie')
+# Rows per line of streamed (NDJSON) align and luna data
+STREAM_CHUNK_SIZE  = 1000
+# process_data parameters of an order besides the target
+DESIGN_KEYS        = (
+	'accessibility_check', 'accessibility_window', 'terminal_check', 'strand_check', 'end_check',
+	'end_stability_treshold', 'target_site_accessibility_treshold', 'min_gc_range', 'max_gc_range',
+	'right_end_type', 'remove_damaging_motifs', 'contiguous_num'
+	)
+# Objects shared by the requests, created on first use so that importing
+# the views starts no threads and writes no files
+_shared            = {}
+_shared_lock       = threading.Lock()
+
+
+def shared(name, create):
+	"""Return the shared object name, made by create() on first use."""
+	with _shared_lock:
+		if name not in _shared:
+			_shared[name] = create()
+		return _shared[name]
+
+
+def get_disk_cache():
+	"""The on-disk cache of RNAplfold and bowtie results."""
+	return shared('disk_cache', lambda: cache.DiskCache(path.join(settings.BASE_DIR, 'cache')))
+
+
+def get_pipelines():
+	"""Pipelines of the designs by session id (run_pipeline returns it)."""
+	return shared('pipelines', lambda: registry.PipelineRegistry(spill_directory=path.join(settings.BASE_DIR, 'cache', 'sessions')))
+
+
+def get_job_queue():
+	"""Background runs of run_pipeline, polled at jobs/<job_id>."""
+	return shared('job_queue', jobs.JobQueue)
+
+
+def ndjson_response(objects):
+	"""Stream objects as newline delimited JSON, one object per line."""
+	lines = (json.dumps(obj) + '\n' for obj in objects)
+	return StreamingHttpResponse(lines, content_type='application/x-ndjson')
+
+
+def luna_rows(luna_data):
+	"""The lunp matrix as lists, probabilities rounded to the digits RNAplfold printed."""
+	rows = luna_data.astype('float64')
+	rows[:, 1:] = pipeline.round_probabilities(luna_data[:, 1:])
+	return rows.tolist()
+
+
+def pipeline_lines(session_id, align_data, luna_data):
+	"""
+	Lines of a streamed run_pipeline response: the session id, then chunks
+	of align and luna data. The pipeline run is finished before the first
+	line, only the conversion to JSON is done chunk by chunk while the
+	response is sent.
+	"""
+	yield {'session_id': session_id}
+	rows = align_data.iter_rows()
+	chunk = list(islice(rows, STREAM_CHUNK_SIZE))
+	while chunk:
+		yield {'align_data': chunk}
+		chunk = list(islice(rows, STREAM_CHUNK_SIZE))
+	for start in range(0, len(luna_data), STREAM_CHUNK_SIZE):
+		yield {'luna_data': luna_rows(luna_data[start:start+STREAM_CHUNK_SIZE])}
+
+def add_session(sifi, order):
+	"""Register a pipeline with the design parameters of its order, process_data falls back to them."""
+	sifi.design = {key: order[key] for key in DESIGN_KEYS if key in order}
+	return get_pipelines().add(sifi)
 
 @csrf_exempt
 def create_database(request):
@@ -21,7 +97,8 @@ def create_database(request):
 		db_name = order['text']
 		database_file_location  = order['path']
 
-	info_message, bowtie_path, fdate, fsize = database_helpers.create_bowtie_database(db_name,database_file_location,bowtie_location)
+	info_message, bowtie_path, fdate, fsize = database_helpers.create_bowtie_database(
+		db_name, database_file_location, bowtie_location, kmer_sizes=order.get('kmer_sizes'))
 	response = dict()
 	if bowtie_path:
 		response['msg'] = info_message
@@ -37,73 +114,276 @@ def get_all_databases_info(request):
 	response = database_helpers.all_dbs(bowtie_location)
 	return JsonResponse(response)
 
+def query_options(order):
+	"""
+	The SifiPipeline.run_pipeline arguments of an order, with the query
+	sequences saved as a FASTA file, and the number of query sequences.
+	"""
+	sequences = order['sequences']
+	is_sequence = general_helpers.validate_seq(sequences)
+	fasta = general_helpers.validate_fasta_seq(sequences)
+
+	if is_sequence:
+		sequences = '>' + 'my_sequence' + '\n' + sequences
+		sequence_temp_file = general_helpers.save_seq_file(sequences)
+		fasta = 1
+	elif fasta:
+		sequence_temp_file = general_helpers.save_seq_file(sequences)
+	else:
+		raise ValueError('Please enter a valid nucleic acid sequence!')
+	pipeline_options = dict(
+		bowtie_db = order['database'],
+		rnaplfold_location = rnaplfold_location,
+		bowtie_location = bowtie_location,
+		query_sequences = sequence_temp_file,
+		sirna_size = order['siRNA_size'],
+		mismatches = order['mismatch']
+		)
+	return pipeline_options, fasta
+
 @csrf_exempt
 def run_pipeline(request):
 
-	global sifi
 	order = dict()
 	response = dict()
-	sequence_temp_file = ''
 
 	if request.method == 'POST':
 		order = json.loads(request.body)
 
-	sequences = order['sequences']
-	is_sequence = general_helpers.validate_seq(sequences)
-	# fasta = general_helpers.validate_fasta_seq(sequences)
-
-	if is_sequence:
-	    sequences = '>' + 'my_sequence' + '\n' + sequences
-	    sequence_temp_file = general_helpers.save_seq_file(sequences)
-	# elif fasta == 1:
-	# 	sequence_temp_file = general_helpers.save_seq_file(sequences)
-	# elif fasta > 1:
-	# 	sequence_temp_file = False
-	# 	print("Please enter only one sequence or use the batch mode.")
-	else:
-		# sequence_temp_file = False
-		raise ValueError('Please enter a valid nucleic acid sequence!')
-	if sequence_temp_file:
-		sifi = pipeline.SifiPipeline()
-		align_data, luna_data = sifi.run_pipeline(
-			bowtie_db = order['database'],
-	        rnaplfold_location = rnaplfold_location,
-	        bowtie_location = bowtie_location,
-	        query_sequences = sequence_temp_file,
-	        sirna_size = order['siRNA_size'],
-	        mismatches = order['mismatch']
-	    )
-		response['align_data'] = align_data
-		response['luna_data']  = luna_data.tolist()
+	pipeline_options, records = query_options(order)
+	if records > 1:
+		return run_batch(order, pipeline_options)
+	sifi = pipeline.SifiPipeline(cache=get_disk_cache())
+	align_data, luna_data = sifi.run_pipeline(**pipeline_options)
+	session_id = add_session(sifi, order)
+	if order.get('stream'):
+		return ndjson_response(pipeline_lines(session_id, align_data, luna_data))
+	response['session_id'] = session_id
+	response['align_data'] = align_data.rows()
+	if order.get('luna_data', True):
+		response['luna_data']  = luna_rows(luna_data)
 	return JsonResponse(response)
 
+def run_batch(order, pipeline_options):
+	"""
+	Batch mode of run_pipeline for multi FASTA input: the records run in the
+	process pool of SifiPipeline.iter_batch and each gets its own session.
+	The response lists the records in order; streamed, one line is sent per
+	finished record with the progress ('done' of 'total' records).
+	"""
+	sifi = pipeline.SifiPipeline(cache=get_disk_cache())
+	if order.get('stream'):
+		batch = sifi.iter_batch(design=order.get('design'), **pipeline_options)
+		return ndjson_response(
+			{'done': done, 'total': total, 'record': batch_record(record_id, result, order)}
+			for record_id, result, done, total in batch
+			)
+	return JsonResponse({'records': batch_records(sifi, order, pipeline_options)})
+
+def batch_records(sifi, order, pipeline_options, progress=None):
+	"""The responses of the records of a batch in record order, see SifiPipeline.run_batch for progress."""
+	results = sifi.run_batch(design=order.get('design'), progress=progress, **pipeline_options)
+	return [batch_record(record_id, result, order) for record_id, result in results.items()]
+
+def batch_record(record_id, result, order):
+	"""The response of one batch record, its pipeline is registered as a session."""
+	if 'error' in result:
+		return {'record_id': record_id, 'error': result['error']}
+	record = {
+		'record_id': record_id,
+		'session_id': add_session(result['pipeline'], order),
+		'align_data': result['align_data'].rows()
+		}
+	if order.get('luna_data', True):
+		record['luna_data'] = luna_rows(result['lunp_data'])
+	if 'table_data' in result:
+		record['table_data'] = result['table_data']
+	return record
+
+@csrf_exempt
+def submit_job(request):
+	"""
+	Queue a run_pipeline order and return its 'job_id' right away. The
+	result of the job is the run_pipeline response (not streamed); with a
+	'design' (keyword arguments of process_data) it also holds the
+	'table_data' of the designed siRNAs.
+	"""
+	order = dict()
+	if request.method == 'POST':
+		order = json.loads(request.body)
+	try:
+		pipeline_options, records = query_options(order)
+		job_id = get_job_queue().submit(pipeline_job, order, pipeline_options, records)
+	except ValueError as e:
+		return JsonResponse({'msg': str(e)}, status=400)
+	except jobs.QueueFull as e:
+		return JsonResponse({'msg': str(e)}, status=503)
+	return JsonResponse({'job_id': job_id}, status=202)
+
+def pipeline_job(progress, order, pipeline_options, records):
+	"""Run a submitted order, reporting the stage ('alignment', 'folding', 'scoring' or the finished 'records' of a batch)."""
+	sifi = pipeline.SifiPipeline(cache=get_disk_cache())
+	design = order.get('design')
+	if records > 1:
+		progress('records', 0, records)
+		record_progress = lambda record_id, done, total: progress('records', done, total)
+		return {'records': batch_records(sifi, order, pipeline_options, record_progress)}
+	align_data, luna_data = sifi.run_pipeline(progress=progress, **pipeline_options)
+	response = {'align_data': align_data.rows()}
+	if order.get('luna_data', True):
+		response['luna_data'] = luna_rows(luna_data)
+	if design:
+		progress('scoring')
+		response['table_data'] = sifi.process_data(**design)
+	response['session_id'] = add_session(sifi, order)
+	return response
+
+def job_status(request, job_id):
+	"""State, stage and progress of a job, with its result once it is done."""
+	job = get_job_queue().get(job_id)
+	if job is None:
+		return JsonResponse({'msg': 'Unknown job.'}, status=404)
+	return JsonResponse(job)
+
 @csrf_exempt
 def process_data(request):
 
 	response = dict()
 	if request.method == 'POST':
 		order = json.loads(request.body)
-		table_data = sifi.process_data(
-			target = order['target'],
-			accessibility_check = order['accessibility_check'],
-	        accessibility_window = order['accessibility_window'],
-	        terminal_check = order['terminal_check'],
-	        strand_check = order['strand_check'],
-	        end_check = order['end_check'],
-	        end_stability_treshold = order['end_stability_treshold'],
-	        target_site_accessibility_treshold = order['target_site_accessibility_treshold'],
-	        min_gc_range = order['min_gc_range'],
-	        max_gc_range = order['max_gc_range'],
-	        right_end_type = order['right_end_type'],
-	        remove_damaging_motifs = order['remove_damaging_motifs'],
-	        contiguous_num = order['contiguous_num']
-			)
+		sifi = get_pipelines().get(order.get('session_id'))
+		if sifi is None:
+			return JsonResponse({'msg': 'No pipeline results, please run the pipeline first.'}, status=404)
+		paged = any(key in order for key in ('page', 'page_size', 'sort_by', 'columns'))
+		if paged and 'target' not in order:
+			# Another page of the last selection
+			return candidate_page(sifi, order)
+		# Parameters missing from the order are those of the pipeline run
+		design = dict(sifi.design, **{key: order[key] for key in DESIGN_KEYS if key in order})
+		if 'target' in order:
+			design['target'] = order['target']
+		missing = [key for key in ('target',) + DESIGN_KEYS if key not in design]
+		if missing:
+			return JsonResponse({'msg': 'Missing design parameters: ' + ', '.join(missing)}, status=400)
+		if order.get('stream'):
+			# The whole table is scored and filtered before the response
+			# starts (the scoring is vectorized); only the conversion of the
+			# selected rows to records and JSON is chunked, one per line
+			table = sifi.select_candidates(**design)
+			return ndjson_response(sifi.iter_records(table))
+		if paged:
+			sifi.select_candidates(**design)
+			return candidate_page(sifi, order)
+		table_data = sifi.process_data(**design)
 		response['table_data']     = table_data
 		# response['json_lst']       = json_lst
 		# response['eff_sirna_plot'] = eff_sirna_plot
 		# response['main_histo']     = main_histo
 	return JsonResponse(response, safe=False)
 
+def candidate_page(sifi, order):
+	"""
+	One page of the selected candidates: 'page' (1-based), 'page_size'
+	(-1 for all, other sizes below 1 are taken as 1), 'sort_by' with
+	'descending' and the 'columns' to send.
+	"""
+	try:
+		page = int(order.get('page', 1))
+		page_size = int(order.get('page_size', 50))
+		if page_size != -1:
+			page_size = max(page_size, 1)
+		total, table_data = sifi.candidate_page(
+			page = page,
+			page_size = None if page_size == -1 else page_size,
+			sort_by = order.get('sort_by'),
+			descending = bool(order.get('descending', False)),
+			columns = order.get('columns')
+			)
+	except (TypeError, ValueError) as e:
+		return JsonResponse({'msg': str(e)}, status=400)
+	return JsonResponse({
+		'table_data': table_data,
+		'total': total,
+		'page': page,
+		'page_size': page_size
+		})
+
+@csrf_exempt
+def off_target_report(request):
+	"""
+	Off-target report of a session: hits and efficient hits per target, the
+	covered [start, stop) intervals per target of the on-target, off-target
+	and efficient siRNAs, and the number of on-target siRNAs covering every
+	query position. 'target' defaults to the target of the last process_data.
+	"""
+	order = dict()
+	if request.method == 'POST':
+		order = json.loads(request.body)
+	sifi = get_pipelines().get(order.get('session_id'))
+	if sifi is None:
+		return JsonResponse({'msg': 'No pipeline results, please run the pipeline first.'}, status=404)
+	try:
+		summary = sifi.off_target_summary(order.get('target'))
+	except ValueError as e:
+		return JsonResponse({'msg': str(e)}, status=400)
+	return JsonResponse({
+		'table': summary.table(),
+		'on_target': summary.intervals('on_target'),
+		'off_target': summary.intervals('off_target'),
+		'efficient': summary.intervals('efficient'),
+		'coverage': summary.coverage.tolist()
+		})
+
+@csrf_exempt
+def accessibility(request):
+	"""
+	Accessibility profile of a session as float32 (little endian): the
+	unpaired probabilities of one window ('window', default 8) for every
+	position from the first one on, or with 'full' the whole lunp matrix.
+	'format' is 'base64' (JSON) or 'binary' (application/octet-stream with
+	the X-First-Position, X-Window and X-Shape headers).
+	"""
+	order = dict()
+	if request.method == 'POST':
+		order = json.loads(request.body)
+	sifi = get_pipelines().get(order.get('session_id'))
+	if sifi is None:
+		return JsonResponse({'msg': 'No pipeline results, please run the pipeline first.'}, status=404)
+
+	lunp_data, sirna_size = sifi.accessibility_profile()
+	window = int(order.get('window', 8))
+	if order.get('full'):
+		values = lunp_data
+	elif 1 <= window < lunp_data.shape[1]:
+		values = lunp_data[:, window]
+	else:
+		return JsonResponse({'msg': 'Window must be between 1 and the siRNA size.'}, status=400)
+	first_position = int(lunp_data[0, 0]) if len(lunp_data) else sirna_size
+
+	if order.get('format', 'base64') == 'binary':
+		response = HttpResponse(values.tobytes(), content_type='application/octet-stream')
+		response['X-First-Position'] = str(first_position)
+		response['X-Window'] = 'full' if order.get('full') else str(window)
+		response['X-Shape'] = ','.join(map(str, values.shape))
+		return response
+	return JsonResponse({
+		'first_position': first_position,
+		'window': 'full' if order.get('full') else window,
+		'dtype': 'float32',
+		'shape': list(values.shape),
+		'data': base64.b64encode(values.tobytes()).decode(),
+	})
+
+@csrf_exempt
+def close_session(request):
+	"""Forget the pipelines of the given sessions ('session_ids')."""
+	order = dict()
+	if request.method == 'POST':
+		order = json.loads(request.body)
+	for session_id in order.get('session_ids', []):
+		get_pipelines().remove(session_id)
+	return JsonResponse({'msg': 'Success'})
+
 @csrf_exempt
 def removeDatabase(request):
 
@@ -148,6 +428,9 @@ def exportTable(request):
 		order = json.loads(request.body)
 		path = order['path']
 
+		sifi = get_pipelines().get(order.get('session_id'))
+		if sifi is None:
+			return JsonResponse({'msg': 'No pipeline results, please run the pipeline first.'}, status=404)
 		sifi.export(path)
 
 		response = {'code':'200'}
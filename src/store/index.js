@@ -8,8 +8,11 @@ Vue.use(Vuex)
 const state = {
 	databases:[],
   alignData:[],
-  lunaData:[],
-  plot_data:[]
+  lunaData:{ positions:[], values:[] },
+  sessionId:null,
+  batchRecords:[],
+  plot_data:[],
+  plot_total:0
 }
 
 export default new Vuex.Store({
@@ -16,5 +16,11 @@ export default {
 	},
 	addLunaData(state, data) {
 		state.lunaData = data
+	},
+	setSessionId(state, sessionId) {
+		state.sessionId = sessionId
+	},
+	setBatchRecords(state, records) {
+		state.batchRecords = records
 	}
 }
\ No newline at end of file